@@ -0,0 +1,29 @@
+"""Offline benchmarks of the scraping code, run from the project root, e.g.
+
+    python -m bench.parse_item
+
+The fixtures are made up pages following the markup of HobbyKing pages.
+Pages recorded from the site with bench.record go to RECORDED instead.
+"""
+import os
+import timeit
+
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+RECORDED = os.path.join(FIXTURES, 'recorded')
+
+
+def fixture_names(prefix, directory=FIXTURES):
+    return sorted(name for name in os.listdir(directory)
+                  if name.startswith(prefix) and name.endswith('.html'))
+
+
+def load_fixture(name, directory=FIXTURES):
+    "Returns the raw bytes, like urlfetch"
+    with open(os.path.join(directory, name), 'rb') as f:
+        return f.read()
+
+
+def pages_per_sec(parse, pages, repeat=5):
+    best = min(timeit.repeat(lambda: map(parse, pages), number=1, repeat=repeat))
+    return len(pages) / best
@@ -0,0 +1,60 @@
+"""Category page parsing: the offset based parser on the raw response
+against the string splitting that scrape_category() used to do on the
+decoded page.
+"""
+import re
+
+from wnr.extract import category_links, CategoryLinks
+
+from . import fixture_names, load_fixture, pages_per_sec
+
+
+href = re.compile(r'href="(.+?)"')
+
+
+def legacy_category_links(content):
+    html = content.decode('utf-8')
+
+    items = html.split('id="products-list"', 1)
+    if len(items) == 1:
+        items = html.split('class="products-grid', 1)
+    if len(items) > 1:
+        items = items[1].split('class="toolbar-bottom', 1)[0] \
+                        .split('<li class="item')[1:]
+        item_urls = [href.search(item).group(1) for item in items]
+    else:
+        item_urls = None
+
+    npage = re.search(r'href="([^"]+)" title="Next"', html)
+
+    sub_cats = html.split('class="popularBrands', 1)
+    if len(sub_cats) > 1:
+        sub_cats = sub_cats[1].rsplit('class="brandImage', 1)
+        assert len(sub_cats) == 2
+        sub_cats = href.findall(sub_cats[0])
+    else:
+        sub_cats = []
+
+    return CategoryLinks(items=item_urls,
+                         next_page=npage and npage.group(1),
+                         brands=sub_cats)
+
+
+def main():
+    names = fixture_names('category-')
+    pages = [load_fixture(name) for name in names]
+    for name, content in zip(names, pages):
+        legacy, offsets = legacy_category_links(content), category_links(content)
+        assert legacy == offsets, \
+            "%s: results differ\n%r\n%r" % (name, legacy, offsets)
+    print "Parsing %d category pages (%d kB on average):" \
+          % (len(pages), sum(map(len, pages)) / len(pages) / 1000)
+    legacy = pages_per_sec(legacy_category_links, pages)
+    offsets = pages_per_sec(category_links, pages)
+    print "- decode and split: %.1f pages/sec" % legacy
+    print "- offsets: %.1f pages/sec" % offsets
+    print "Speedup: %.1fx" % (offsets / legacy)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""Item page parsing: the single pass extractor against the separate
+regex scans that scrape_item() used to run.
+"""
+import re
+
+from wnr.extract import item_markers, ItemMarkers
+
+from . import fixture_names, load_fixture, pages_per_sec
+
+
+def legacy_item_markers(html):
+    def first(pattern, flags=0):
+        m = re.search(pattern, html, flags)
+        return m and m.group(1)
+
+    prod = re.search(r"oro_gtm.regProduct\((\d+),(\{.+\})\);", html)
+
+    cat_html = html.split('class="breadcrumbsPos"', 1)
+    if len(cat_html) > 1:
+        cat_html = cat_html[1].split('</ul>', 1)[0]
+        cats = re.findall(r'<a href="(.+?)".*?><.+?>(.+?)</', cat_html)
+    else:
+        cats = None
+
+    return ItemMarkers(
+        itemprops=re.findall(r'itemprop="(.+?)" content="(.+?)"', html),
+        og=re.findall(r'property="og:(.+?)" content="(.+?)"', html),
+        oro_currency=first(r'oroGTM\(\'gtm\',\{"id":".+?","currency":"(.+?)"'),
+        oro_product=prod and prod.groups(),
+        button_sku=first(r'<button type="submit" id="btn-sticky-bar-.+?" title="Buy now" class="button btn-cart" data-product-sku *= *"(.+?)"'),
+        google_tag_params=first(r'google_tag_params = *\{(.*?)\}', re.DOTALL),
+        title=first(r"<title>(.+?)</title>", re.DOTALL),
+        breadcrumbs=cats,
+        product_ids=re.findall(r"product_value = (\d+);", html)
+                    + re.findall(r'<input type="hidden" name="product" value="(\d+)"', html))
+
+
+def normalized(markers):
+    # the scan order of product IDs differs, scrape_item() uses a set
+    return markers._replace(product_ids=sorted(markers.product_ids))
+
+
+def main():
+    names = fixture_names('item-')
+    pages = [load_fixture(name).decode('utf-8') for name in names]
+    for name, html in zip(names, pages):
+        legacy, single = legacy_item_markers(html), item_markers(html)
+        assert normalized(legacy) == normalized(single), \
+            "%s: results differ\n%r\n%r" % (name, legacy, single)
+    print "Parsing %d item pages (%d kB on average):" \
+          % (len(pages), sum(map(len, pages)) / len(pages) / 1000)
+    legacy = pages_per_sec(legacy_item_markers, pages)
+    single = pages_per_sec(item_markers, pages)
+    print "- separate scans: %.1f pages/sec" % legacy
+    print "- single pass: %.1f pages/sec" % single
+    print "Speedup: %.1fx" % (single / legacy)
+
+
+if __name__ == "__main__":
+    main()
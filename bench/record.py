@@ -0,0 +1,44 @@
+"""Records pages of the site for bench.scrape --recorded, e.g.
+
+    python -m bench.record https://hobbyking.com/en_us/power-systems.html ...
+
+Each URL is saved as served, as the next item-<n>.html or category-<n>.html
+in bench/fixtures/recorded, by whether the page is a product page.
+"""
+import argparse
+import os
+import urllib2
+
+from wnr.extract import item_markers
+
+from . import fixture_names, RECORDED
+
+
+# like a browser, the site answers differently to unknown clients
+USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64; rv:50.0) Gecko/20100101 Firefox/50.0"
+
+
+def record(url):
+    rq = urllib2.Request(url, headers={'User-Agent': USER_AGENT})
+    content = urllib2.urlopen(rq, timeout=30).read()
+    og = dict(item_markers(content.decode('utf-8')).og)
+    prefix = 'item-' if og.get('type') == "product" else 'category-'
+    name = "%s%d.html" % (prefix, len(fixture_names(prefix, RECORDED)) + 1)
+    with open(os.path.join(RECORDED, name), 'wb') as f:
+        f.write(content)
+    print "%s: %s (%d kB)" % (name, url, len(content) / 1024)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('urls', nargs='+')
+    args = parser.parse_args()
+
+    if not os.path.isdir(RECORDED):
+        os.makedirs(RECORDED)
+    for url in args.urls:
+        record(url)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+"""Scraping throughput against a local copy of the site. Needs the App Engine
+SDK, whose in-memory stubs stand in for the datastore, search, memcache and
+task queue. Run with e.g.
+
+    PYTHONPATH=~/google_appengine python -m bench.scrape --latency .05
+
+The fixture pages are served by a fake urlfetch under generated URLs, items
+with unique SKUs, and some of them answering 301 or 404. Each pass scrapes
+all the pages with hk.scrape_page(), like a crawl would, and then indexes
+the queued items. The later passes send conditional requests, and get 304
+for all but `--changed` of them. The reported stage times include the
+nested stages.
+
+With `--recorded`, the pages recorded with bench.record are served
+instead of the made up fixtures. Those measure the parsing of real pages,
+but the stubs still don't have the latencies of the real services, so
+the numbers compare revisions rather than predict production.
+"""
+from Cookie import SimpleCookie
+from collections import defaultdict
+import argparse
+import functools
+import hashlib
+import logging
+import os
+import random
+import sys
+import time
+
+try:
+    import dev_appserver
+except ImportError:
+    sys.exit("The App Engine SDK needs to be in PYTHONPATH")
+else:
+    dev_appserver.fix_sys_path()
+
+from google.appengine.api import apiproxy_stub, apiproxy_stub_map
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb, testbed
+
+from wnr import hk, search
+from wnr.extract import item_markers
+from wnr.models import PAGE_TYPE, SiteScan
+
+from . import FIXTURES, fixture_names, load_fixture, RECORDED
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Page(object):
+    def __init__(self, url_type, status, content="", location=None):
+        self.url_type = url_type
+        self.status = status
+        self.content = content
+        self.location = location
+        self.etag = '"%s"' % hashlib.md5(content).hexdigest()
+
+    def change(self):
+        # a price or stock update
+        self.content += "<!-- changed -->"
+        self.etag = '"%s"' % hashlib.md5(self.content).hexdigest()
+
+
+def build_site(items, categories, redirects, missing, seed=1,
+               directory=FIXTURES):
+    """Returns {url: Page}. The item fixtures are copied under new URLs,
+    SKUs and product IDs, the category fixtures are served as such under
+    new URLs.
+    """
+    rnd = random.Random(seed)
+    site = {}
+
+    templates = []
+    for name in fixture_names('item-', directory):
+        content = load_fixture(name, directory)
+        markers = item_markers(content.decode('utf-8'))
+        og = dict(markers.og)
+        templates.append((content, og['url'].encode('utf-8'),
+                          dict(markers.itemprops)['sku'].encode('utf-8'),
+                          markers.product_ids[0].encode('utf-8')))
+
+    item_urls = []
+    for n in xrange(items):
+        content, url, sku, pid = templates[n % len(templates)]
+        new_url = "https://hobbyking.com/en_us/bench-item-%d.html" % n
+        content = content.replace(url, new_url) \
+                         .replace(sku, "%s-%d" % (sku, n)) \
+                         .replace(pid, str(1000000 + n))
+        site[new_url] = Page(PAGE_TYPE.ITEM, 200, content)
+        item_urls.append(new_url)
+
+    broken = {url for url in item_urls
+              if rnd.random() < missing + redirects}
+    found = [url for url in item_urls if url not in broken]
+    for url in sorted(broken):
+        if rnd.random() < missing / (missing + redirects):
+            site[url] = Page(PAGE_TYPE.ITEM, 404, "Not found")
+        else:
+            # never to another redirect
+            site[url] = Page(PAGE_TYPE.ITEM, 301, location=rnd.choice(found))
+
+    cat_fixtures = fixture_names('category-', directory)
+    for n in xrange(categories):
+        url = "https://hobbyking.com/en_us/bench-category-%d.html" % n
+        content = load_fixture(cat_fixtures[n % len(cat_fixtures)], directory)
+        site[url] = Page(PAGE_TYPE.CATEGORY, 200, content)
+
+    return site
+
+
+class FakeUrlFetch(apiproxy_stub.APIProxyStub):
+    """Serves the pages of build_site(), after `latency` seconds."""
+
+    def __init__(self, site, latency=0):
+        super(FakeUrlFetch, self).__init__('urlfetch')
+        self.site = site
+        self.latency = latency
+
+    def _Dynamic_Fetch(self, request, response):
+        if self.latency:
+            time.sleep(self.latency)
+
+        page = self.site.get(request.url())
+        headers = {h.key().lower(): h.value() for h in request.header_list()}
+        if not page:
+            status, content, rs_headers = 404, "Not found", {}
+        elif page.status == 200 \
+             and headers.get('if-none-match') == page.etag:
+            status, content, rs_headers = 304, "", {'ETag': page.etag}
+        elif page.status == 200:
+            status, content = 200, page.content
+            rs_headers = {'Content-Type': "text/html; charset=UTF-8",
+                          'ETag': page.etag}
+        elif page.status in (301, 302):
+            status, content = page.status, ""
+            rs_headers = {'Location': page.location}
+        else:
+            status, content, rs_headers = page.status, page.content, {}
+
+        response.set_statuscode(status)
+        response.set_content(content)
+        for key, value in rs_headers.iteritems():
+            header = response.add_header()
+            header.set_key(key)
+            header.set_value(value)
+
+
+class Stages(object):
+    """Accumulates the time spent in wrapped functions."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.time = defaultdict(float)
+        self.calls = defaultdict(int)
+
+    def wrap(self, name, fn):
+        @functools.wraps(fn)
+        def timed(*args, **kw):
+            start = time.time()
+            try:
+                return fn(*args, **kw)
+            finally:
+                self.time[name] += time.time() - start
+                self.calls[name] += 1
+        return timed
+
+    def report(self, wall):
+        for name in sorted(self.time, key=self.time.get, reverse=True):
+            print "- %-20s %6d calls %8.1fms each %5.1f%%" \
+                  % (name,
+                     self.calls[name],
+                     self.time[name] / self.calls[name] * 1000,
+                     self.time[name] / wall * 100)
+
+
+def setup(site, latency):
+    tb = testbed.Testbed()
+    tb.activate()
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+    tb.init_datastore_v3_stub(consistency_policy=policy)
+    tb.init_memcache_stub()
+    tb.init_search_stub()
+    # for queue.yaml
+    tb.init_taskqueue_stub(root_path=ROOT)
+    tb._register_stub(testbed.URLFETCH_SERVICE_NAME, FakeUrlFetch(site, latency))
+    # like main.py
+    ndb.get_context().set_cache_policy(False)
+    SiteScan.initialize(hk._store.id, skip_indexed=False)
+    return tb
+
+
+def instrument(stages):
+    # called through the module globals
+    for name in ('scrape_page', 'scrape_item', 'scrape_category',
+                 'save_cats', 'item_markers', 'category_links'):
+        setattr(hk, name, stages.wrap(name, getattr(hk, name)))
+    for name in ('index_queued', 'index_items'):
+        setattr(search, name, stages.wrap(name, getattr(search, name)))
+
+    for service in ('datastore_v3', 'memcache', 'search', 'taskqueue', 'urlfetch'):
+        stub = apiproxy_stub_map.apiproxy.GetStub(service)
+        stub.MakeSyncCall = stages.wrap("api:" + service, stub.MakeSyncCall)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--items', type=int, default=300)
+    parser.add_argument('--categories', type=int, default=30)
+    parser.add_argument('--latency', type=float, default=0,
+                        help="seconds per fetch")
+    parser.add_argument('--redirects', type=float, default=.05,
+                        help="share of items answering 301")
+    parser.add_argument('--missing', type=float, default=.05,
+                        help="share of items answering 404")
+    parser.add_argument('--recorded', action='store_true',
+                        help="serve the pages recorded with bench.record")
+    parser.add_argument('--passes', type=int, default=2)
+    parser.add_argument('--changed', type=float, default=.1,
+                        help="share of pages changed between passes")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.ERROR)
+    site = build_site(args.items, args.categories, args.redirects, args.missing,
+                      directory=RECORDED if args.recorded else FIXTURES)
+    tb = setup(site, args.latency)
+    try:
+        stages = Stages()
+        instrument(stages)
+        rnd = random.Random(2)
+        pages = sorted(site.iteritems())
+        for n in range(args.passes):
+            if n:
+                for url, page in pages:
+                    if page.status == 200 and rnd.random() < args.changed:
+                        page.change()
+
+            stages.reset()
+            start = time.time()
+            for url, page in pages:
+                # as if the last retry, so that 404s flag items removed
+                hk.scrape_page(page.url_type, url, SimpleCookie(), retries=2)
+            # the deferred consumer of the pull queue
+            search.index_queued()
+            wall = time.time() - start
+
+            print "Pass %d: %d pages in %.1fs, %.1f pages/sec" \
+                  % (n + 1, len(pages), wall, len(pages) / wall)
+            stages.report(wall)
+    finally:
+        tb.deactivate()
+
+
+if __name__ == "__main__":
+    main()
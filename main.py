@@ -6,7 +6,7 @@ import webapp2
 from webapp2_extras import routes
 
 from settings import env
-from wnr import hk, util, views
+from wnr import hk, search, util, views
 
 
 # disable in-context cache (the newbie helper)
@@ -34,6 +34,8 @@ app = webapp2.WSGIApplication([
     util.get(r"/about", views.about),
     webapp2.Route(r"/i/<store:\w+>/<sku:.+>", views.item_image, methods=('GET', 'HEAD')),
     util.get(r"/<store:\w+>/categories", views.categories),
+    util.get(r"/_exchange-rates", search.trigger_rate_refresh),
+    util.get(r"/_migrations", views.trigger_migrations),
     routes.PathPrefixRoute(r"/_hk", hk.routes),
     # get(r"/<store:\w+>", views.store),
 ], debug=False)
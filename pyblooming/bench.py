@@ -0,0 +1,93 @@
+"""
+Micro-benchmarks for the Bloom filter implementations. Run with:
+
+    python -m pyblooming.bench
+"""
+import random
+import timeit
+
+import zlib
+
+from bloom import BloomFilter, bitmaplib
+from counting import CountingBloomFilter
+from scalable import ScalableBloomFilter
+
+
+def sample_keys(count, salt=12345):
+    "Returns salted URL-like keys similar to the ones SiteScan uses"
+    rnd = random.Random(count)
+    return ["%d$https://hobbyking.com/en_us/item-%d-%s.html"
+            % (salt, n, "x" * rnd.randint(20, 80))
+            for n in xrange(count)]
+
+
+def time_per_key(fn, keys, repeat=3):
+    "Returns the best time per key in microseconds"
+    best = min(timeit.repeat(lambda: fn(keys), number=1, repeat=repeat))
+    return best / len(keys) * 1e6
+
+
+def bench_hashes(capacity=100000, prob=.01, count=20000):
+    keys = sample_keys(count)
+    print "Hashing %d keys, filter for (%d, %s):" % (count, capacity, prob)
+    results = {}
+    for version in (BloomFilter.HASH_LEGACY, BloomFilter.HASH_DOUBLE):
+        size, k = BloomFilter.params_for_capacity(capacity, prob)
+        bf = BloomFilter(bitmaplib.Bitmap(size), k, hash_version=version)
+
+        def add(keys):
+            for key in keys:
+                bf.add(key)
+
+        def contains(keys):
+            for key in keys:
+                key in bf
+
+        results[version] = (time_per_key(add, keys),
+                            time_per_key(contains, keys),
+                            time_per_key(bf.add_many, keys),
+                            time_per_key(bf.contains_many, keys))
+        print "- hash version %d (k=%d): add %.1fus, contains %.1fus, " \
+              "add_many %.1fus, contains_many %.1fus per key" \
+              % ((version, k) + results[version])
+
+    legacy, double = results[BloomFilter.HASH_LEGACY], results[BloomFilter.HASH_DOUBLE]
+    print "Speedup: add %.1fx, contains %.1fx" \
+          % (legacy[0] / double[0], legacy[1] / double[1])
+
+
+def bench_memory(capacity=100000, prob=.01, count=60000):
+    keys = sample_keys(count)
+    others = sample_keys(count, salt=54321)
+    print "Memory with %d keys, filters for (%d, %s):" % (count, capacity, prob)
+
+    bf = BloomFilter.for_capacity(capacity, prob)
+    sbf = ScalableBloomFilter(initial_capacity=capacity / 10, error_rate=prob)
+    cbf = CountingBloomFilter(capacity, prob)
+    for name, f in (("BloomFilter", bf),
+                    ("ScalableBloomFilter", sbf),
+                    ("CountingBloomFilter", cbf)):
+        f.add_many(keys)
+        data = f.tostring()
+        fp_rate = sum(f.contains_many(others)) / float(len(others))
+        print "- %s: %.1f bytes per key (%.1f compressed), " \
+              "false positive rate %.2f%%" \
+              % (name,
+                 len(data) / float(count),
+                 len(zlib.compress(data)) / float(count),
+                 fp_rate * 100)
+
+    # a counting filter after removing a third of the keys
+    removed = keys[:count / 3]
+    for key in removed:
+        cbf.discard(key)
+    still_found = sum(cbf.contains_many(removed)) / float(len(removed))
+    print "- CountingBloomFilter after discarding %d keys: " \
+          "%.2f%% of them still found, all remaining found: %s" \
+          % (len(removed), still_found * 100,
+             all(cbf.contains_many(keys[count / 3:])))
+
+
+if __name__ == "__main__":
+    bench_hashes()
+    bench_memory()
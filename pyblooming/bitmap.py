@@ -1,14 +1,22 @@
 """
 Implements a simple class to address individual bits using
-a memory mapped file.
+a mutable buffer, optionally a memory mapped file.
 """
+import os
+
+# NumPy is optional, used for the bulk operations if available
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 class Bitmap(object):
     def __init__(self, length, filename=None, private=False):
         """
         Creates a new Bitmap object. Bitmap wraps a memory mapped
         file and allows bit-level operations to be performed. A bitmap can
-        either be created on a file or can use an anonymous map.
+        either be created on a file or can use an anonymous in-memory buffer.
 
         :Parameters:
           - `length`: The length of the Bitmap in bytes. The number of bits
@@ -20,10 +28,43 @@ class Bitmap(object):
             version of the memory mapped region. Otherwise, MAP_SHARED is used,
             and changes are reflected to other copies of the file.
         """
-        assert not filename
         self.size = length
         self.fileobj = None
-        self.mmap = chr(0) * length
+        if filename:
+            # mmap isn't available in the App Engine sandbox, only
+            # for local tooling
+            import mmap
+            fileno = os.open(filename, os.O_RDWR | os.O_CREAT)
+            self.fileobj = os.fdopen(fileno, "r+b")
+            # extend the file to the required length
+            if os.fstat(fileno).st_size < length:
+                os.ftruncate(fileno, length)
+            if private:
+                access = mmap.ACCESS_COPY
+            else:
+                access = mmap.ACCESS_WRITE
+            self.mmap = mmap.mmap(fileno, length, access=access)
+            # mmap indexes single characters
+            self._ord, self._chr = ord, chr
+        else:
+            self.mmap = bytearray(length)
+            # bytearray indexes integers
+            self._ord = self._chr = int
+
+    @classmethod
+    def fromstring(cls, data):
+        """
+        Creates an anonymous Bitmap holding a copy of the given
+        serialized bytes, see tostring().
+        """
+        bitmap = cls(0)
+        bitmap.mmap = bytearray(data)
+        bitmap.size = len(bitmap.mmap)
+        return bitmap
+
+    def tostring(self):
+        "Returns the contents of the Bitmap as a byte string"
+        return str(self.mmap[:self.size])
 
     def __len__(self):
         "Returns the size of the Bitmap in bits"
@@ -31,10 +72,8 @@ class Bitmap(object):
 
     def __getitem__(self, idx):
         "Gets the value of a specific bit. Must take an integer argument"
-        byte = idx >> 3
-        byte_off = 7 - idx % 8
-        byte_val = ord(self.mmap[byte])
-        return (byte_val >> byte_off) & 0x1
+        byte_val = self._ord(self.mmap[idx >> 3])
+        return (byte_val >> (7 - idx % 8)) & 0x1
 
     def __setitem__(self, idx, val):
         """
@@ -43,25 +82,81 @@ class Bitmap(object):
         """
         byte = idx >> 3
         byte_off = 7 - idx % 8
-        byte_val = ord(self.mmap[byte])
+        byte_val = self._ord(self.mmap[byte])
         if val:
             byte_val |= 1 << byte_off
         else:
             byte_val &= ~(1 << byte_off)
-        self[byte:byte+1] = chr(byte_val)
+        self.mmap[byte] = self._chr(byte_val)
         return val
 
+    def _array(self):
+        "Returns a writable NumPy view of the buffer, or None"
+        if numpy is None:
+            return None
+        try:
+            buf = numpy.frombuffer(self.mmap, dtype=numpy.uint8)
+        except (TypeError, ValueError):
+            return None
+        if not buf.flags.writeable:
+            return None
+        return buf
+
+    def set_many(self, indexes):
+        """
+        Sets all the given bits to 1. Equivalent to setting each bit
+        separately, but does a single pass over the buffer.
+        """
+        if not len(indexes):
+            return
+        buf = self._array()
+        if buf is not None:
+            idx = numpy.asarray(indexes, dtype=numpy.int64)
+            byte = idx >> 3
+            shift = 7 - (idx & 7)
+            # one vectorized update per bit offset, as duplicate byte
+            # indexes would otherwise lose each other's bits
+            for off in range(8):
+                sel = byte[shift == off]
+                if len(sel):
+                    buf[sel] |= 1 << off
+        else:
+            masks = {}
+            for idx in indexes:
+                byte = idx >> 3
+                masks[byte] = masks.get(byte, 0) | (1 << (7 - idx % 8))
+            for byte, mask in masks.iteritems():
+                self.mmap[byte] = self._chr(self._ord(self.mmap[byte]) | mask)
+
+    def get_many(self, indexes):
+        """
+        Returns the values of all the given bits, as a sequence of
+        0/1 values in the same order.
+        """
+        buf = self._array()
+        if buf is not None:
+            idx = numpy.asarray(indexes, dtype=numpy.int64)
+            return (buf[idx >> 3] >> (7 - (idx & 7))) & 0x1
+        else:
+            return [self[idx] for idx in indexes]
+
     def flush(self):
-        pass
+        if self.fileobj:
+            self.mmap.flush()
 
     def close(self, flush=True):
+        if self.fileobj:
+            if flush:
+                self.flush()
+            self.mmap.close()
+            self.fileobj.close()
+            self.fileobj = None
         self.mmap = None
 
     def __getslice__(self, i, j):
-        "Allow direct access to the mmap, indexed by byte"
-        return self.mmap[i:j]
+        "Allow direct access to the buffer, indexed by byte"
+        return str(self.mmap[i:j])
 
     def __setslice__(self, i, j, val):
-        "Allow direct access to the mmap, indexed by byte"
-        #self.mmap[i:j] = val
-        self.mmap = self.mmap[:i] + val + self.mmap[j:]
+        "Allow direct access to the buffer, indexed by byte"
+        self.mmap[i:j] = val
@@ -2,6 +2,8 @@
 Implements an easy to use Bloom filter on top of
 the bitmap implementation.
 """
+from binascii import hexlify, unhexlify
+import hashlib
 import math
 import struct
 import sys
@@ -15,13 +17,28 @@ except ImportError:
 class BloomFilter(object):
     # This is the packing format we use to store the count
     SIZE_FMT = "<Q"
-    K_NUM_FMT = "<I"
+    # The k num and the hash version share the 4 bytes that used to hold
+    # only the k num, so filters written before versioning read as version 0
+    K_NUM_FMT = "<HH"
 
     # This is how many bytes we need to store the count
     SIZE_LEN = 8
     K_NUM_LEN = 4
 
-    def __init__(self, bitmap, k):
+    # Hash versions: 0 is the original DJB/DEK/FNV/JS family, 1 is
+    # double hashing seeded from a single MD5 digest
+    HASH_LEGACY = 0
+    HASH_DOUBLE = 1
+    HASH_VERSION = HASH_DOUBLE
+
+    # Identifies the self-describing serialized format, see tostring()
+    MAGIC = "BLF\x01"
+
+    # capacity, error rate, k num, hash version, salt
+    HEADER_FMT = "<QdHHQ"
+    HEADER_LEN = struct.calcsize(HEADER_FMT)
+
+    def __init__(self, bitmap, k, hash_version=None):
         """
         Creates a new Bloom Filter instance. A bloom filter
         requires a bitmap underneath.
@@ -32,6 +49,9 @@ class BloomFilter(object):
             determine the amount of additional padding.
           - k : The number of hashing algorithms to
             use. Must be at least 1.
+          - hash_version (optional) : The hash family to use for a new
+            bitmap, defaults to HASH_VERSION. Ignored if the bitmap already
+            records its k num and hash version.
         """
         if bitmap is None or k is None: raise ValueError, "Must provide bitmap and k!"
         if k < 1: raise ValueError, "Bad value provided for k!"
@@ -40,10 +60,17 @@ class BloomFilter(object):
         if self.bitmap_size <= 0: raise ValueError, "Bitmap is not large enough!"
 
         # Restore the k num if we need to
-        self.k_num = self._read_k_num() # Read the existing knum from the file
+        self.k_num, self.hash_version = self._read_k_num() # Read the existing knum from the file
         if self.k_num == 0:
             self.k_num = k
+            if hash_version is None:
+                hash_version = self.HASH_VERSION
+            if hash_version not in (self.HASH_LEGACY, self.HASH_DOUBLE):
+                raise ValueError, "Unknown hash version %r!" % (hash_version,)
+            self.hash_version = hash_version
             self._write_k_num()
+        elif self.hash_version not in (self.HASH_LEGACY, self.HASH_DOUBLE):
+            raise ValueError, "Unknown hash version %r!" % (self.hash_version,)
 
         # Compute the offset size
         self.offset = int(self.bitmap_size / self.k_num)
@@ -52,6 +79,13 @@ class BloomFilter(object):
         self.count = self._read_count() # Read the count from the file
         self.info = {} # Allows dynamic properties
 
+        # Informative, recorded in the serialized header. Keys aren't
+        # salted by the filter, the salt is the one applied by the caller,
+        # if it chooses to record it here. It isn't checked on merging.
+        self.capacity = None
+        self.probability = None
+        self.salt = 0
+
     @classmethod
     def extra_buffer(cls):
         """
@@ -68,7 +102,10 @@ class BloomFilter(object):
         """
         bytes, ideal_k = cls.params_for_capacity(capacity, probability)
         bitmap = bitmaplib.Bitmap(bytes)
-        return BloomFilter(bitmap, ideal_k)
+        bf = BloomFilter(bitmap, ideal_k)
+        bf.capacity = capacity
+        bf.probability = probability
+        return bf
 
     @classmethod
     def params_for_capacity(cls, capacity, probability):
@@ -158,30 +195,93 @@ class BloomFilter(object):
 
         return (djb_hash, dek_hash, fnv_hash, js_hash)
 
+    def _double_hashes(self, key):
+        """
+        Returns the two base hashes used for double hashing
+        (Kirsch-Mitzenmacher), both taken from one MD5 digest
+        """
+        h1, h2 = struct.unpack("<QQ", hashlib.md5(key).digest())
+        # an odd step never degenerates to the same bit in every partition
+        return h1, h2 | 1
+
+    def _bit_positions(self, key):
+        "Returns the k bit positions of a key, one per partition"
+        m = self.offset
+        if self.hash_version == self.HASH_LEGACY:
+            hashes = self._get_hashes(key, self.k_num)
+            return [n * m + (h % m) for n, h in enumerate(hashes)]
+        h1, h2 = self._double_hashes(key)
+        h1, h2 = h1 % m, h2 % m
+        return [n * m + (h1 + n * h2) % m for n in xrange(self.k_num)]
+
+    def _batch_positions(self, keys):
+        """
+        Returns the bit positions of a batch of keys, k per key. With
+        double hashing and NumPy available, the positions are computed
+        as one array.
+        """
+        numpy = getattr(bitmaplib, 'numpy', None)
+        if self.hash_version == self.HASH_LEGACY or numpy is None:
+            positions = []
+            for key in keys:
+                positions.extend(self._bit_positions(key))
+            return positions
+        m = self.offset
+        bases = numpy.array([(h1 % m, h2 % m)
+                             for h1, h2 in map(self._double_hashes, keys)],
+                            dtype=numpy.int64).reshape(len(keys), 2)
+        n = numpy.arange(self.k_num, dtype=numpy.int64)
+        positions = (bases[:, :1] + bases[:, 1:] * n) % m + n * m
+        return positions.ravel()
+
+    def add_many(self, keys, check_first=False):
+        """
+        Adds a batch of keys to the set. The bit positions for the whole
+        batch are computed first and then set in a single pass over the
+        bitmap. Returns the number of keys added.
+        """
+        if check_first:
+            seen = set()
+            unique = []
+            for key in keys:
+                if key not in seen:
+                    seen.add(key)
+                    unique.append(key)
+            keys = [key for key, found in zip(unique, self.contains_many(unique))
+                    if not found]
+        self.bitmap.set_many(self._batch_positions(keys))
+        self.count += len(keys)
+        return len(keys)
+
+    def contains_many(self, keys):
+        """
+        Checks a batch of keys against the set. Returns a list of
+        booleans in the same order as the keys.
+        """
+        if not keys:
+            return []
+        bits = self.bitmap.get_many(self._batch_positions(keys))
+        k = self.k_num
+        if hasattr(bits, 'reshape'):
+            # NumPy array
+            return bits.reshape(len(keys), k).all(axis=1).tolist()
+        return [all(bits[n:n + k]) for n in xrange(0, len(bits), k)]
+
     def add(self, key, check_first=False):
         "Add a key to the set"
         if check_first and key in self: return False
-        hashes = self._get_hashes(key, self.k_num)
-        m = self.offset
-        offset = 0
 
         # Set the bits for the hashes
-        for h in hashes:
-            self.bitmap[offset + (h % m)] = 1
-            offset += m
+        for pos in self._bit_positions(key):
+            self.bitmap[pos] = 1
 
         self.count += 1
         return True
 
     def __contains__(self, key):
         "Checks if the set contains a given key"
-        hashes = self._get_hashes(key, self.k_num)
-        m = self.offset
-        offset = 0
-
-        for h in hashes:
-            if self.bitmap[offset + (h % m)] == 0: return False
-            offset += m
+        for pos in self._bit_positions(key):
+            if self.bitmap[pos] == 0: return False
 
         return True
 
@@ -204,6 +304,128 @@ class BloomFilter(object):
         # Flush the underlying bitmap
         if self.bitmap: self.bitmap.flush()
 
+    def _check_compatible(self, other):
+        """
+        Raises a ValueError if the filters can't be merged. The keys of
+        both filters must also be salted alike, which is up to the caller.
+        """
+        if type(self) is not type(other):
+            raise ValueError, "Can't merge %s with %s!" \
+                              % (type(self).__name__, type(other).__name__)
+        mine = (self.bitmap_size, self.k_num, self.hash_version)
+        theirs = (other.bitmap_size, other.k_num, other.hash_version)
+        if mine != theirs:
+            raise ValueError, "Incompatible filters: %r != %r" % (mine, theirs)
+
+    def _bits(self):
+        "Returns the bit array part of the bitmap, without the meta data"
+        return self.bitmap[0:self.bitmap_size / 8]
+
+    def _merge(self, other, op):
+        """
+        Returns a new filter with the bits of both filters combined with
+        the given operator. The bits are combined word-at-a-time, either as
+        NumPy arrays or as long integers.
+        """
+        self._check_compatible(other)
+        mine, theirs = self._bits(), other._bits()
+        numpy = getattr(bitmaplib, 'numpy', None)
+        if numpy is not None:
+            merged = op(numpy.frombuffer(mine, dtype=numpy.uint8),
+                        numpy.frombuffer(theirs, dtype=numpy.uint8)).tostring()
+        else:
+            merged = op(int(hexlify(mine), 16), int(hexlify(theirs), 16))
+            merged = unhexlify("%0*x" % (2 * len(mine), merged))
+        bitmap = bitmaplib.Bitmap(len(self.bitmap) / 8)
+        bitmap[0:len(merged)] = merged
+        bf = BloomFilter(bitmap, self.k_num, hash_version=self.hash_version)
+        bf.capacity = self.capacity
+        bf.probability = self.probability
+        bf.salt = self.salt
+        bf.count = int(round(bf.estimate_cardinality()))
+        return bf
+
+    def union(self, other):
+        """
+        Returns a new filter containing the keys of both filters. The
+        filters must have the same size, k num and hash version.
+        """
+        return self._merge(other, lambda a, b: a | b)
+
+    def intersection(self, other):
+        """
+        Returns a new filter containing (approximately) the keys found in
+        both filters. It has at least the false positive rate of the
+        fuller filter.
+        """
+        return self._merge(other, lambda a, b: a & b)
+
+    def estimate_cardinality(self):
+        """
+        Estimates the number of distinct keys in the filter from the
+        number of set bits. Unlike the count, this is meaningful also after
+        a union or intersection.
+        """
+        bits = self._bits()
+        numpy = getattr(bitmaplib, 'numpy', None)
+        if numpy is not None:
+            set_bits = int(numpy.unpackbits(numpy.frombuffer(bits, dtype=numpy.uint8)).sum())
+        else:
+            set_bits = bin(int(hexlify(bits), 16)).count("1") if bits else 0
+        return self._cardinality(set_bits)
+
+    def _cardinality(self, set_bits):
+        "Estimates the number of keys that set the given number of bits"
+        # every key sets one bit in each of the k partitions
+        m = self.offset
+        fill = float(set_bits) / (self.k_num * m)
+        if fill >= 1:
+            return float("inf")
+        return math.log(1 - fill) / math.log(1 - 1.0 / m)
+
+    def tostring(self):
+        """
+        Serializes the filter into a byte string: the magic prefix, a header
+        with the capacity, probability, k num, hash version and salt, and the
+        contents of the bitmap.
+        """
+        return self.MAGIC \
+               + struct.pack(self.HEADER_FMT,
+                             self.capacity or 0,
+                             self.probability or 0,
+                             self.k_num,
+                             self.hash_version,
+                             self.salt) \
+               + self.bitmap_string()
+
+    def bitmap_string(self):
+        """
+        Returns the contents of the underlying bitmap, including the
+        count, k num and hash version, as a byte string.
+        """
+        self.flush()
+        return self.bitmap.tostring()
+
+    @classmethod
+    def is_serialized(cls, data):
+        "Checks if the given bytes were produced by tostring()"
+        return bool(data) and data.startswith(cls.MAGIC)
+
+    @classmethod
+    def fromstring(cls, data):
+        "Restores a filter serialized with tostring()"
+        if not cls.is_serialized(data): raise ValueError, "Not a Bloom filter!"
+        offset = len(cls.MAGIC)
+        capacity, probability, k_num, hash_version, salt = \
+            struct.unpack_from(cls.HEADER_FMT, data, offset)
+        offset += cls.HEADER_LEN
+        bf = cls(bitmaplib.Bitmap.fromstring(data[offset:]), k_num)
+        if (bf.k_num, bf.hash_version) != (k_num, hash_version): raise ValueError, "Inconsistent filter header!"
+        bf.capacity = capacity or None
+        bf.probability = probability or None
+        bf.salt = salt
+        return bf
+
     def close(self, flush=True):
         "Closes the bloom filter and the underlying bitmap"
         if self.bitmap:
@@ -223,16 +445,15 @@ class BloomFilter(object):
         return unpacked[0]
 
     def _read_k_num(self):
-        "Reads the k-num we should use"
+        "Reads the k-num and hash version we should use"
         size_offset = self.bitmap_size / 8 + self.SIZE_LEN
         knum_str = self.bitmap[size_offset:size_offset+self.K_NUM_LEN]
-        unpacked = struct.unpack(self.K_NUM_FMT, knum_str)
-        return unpacked[0]
+        return struct.unpack(self.K_NUM_FMT, knum_str)
 
     def _write_k_num(self):
-        "Writes the k-num we should use"
+        "Writes the k-num and hash version we should use"
         size_offset = self.bitmap_size / 8 + self.SIZE_LEN
-        knum_str = struct.pack(self.K_NUM_FMT, self.k_num)
+        knum_str = struct.pack(self.K_NUM_FMT, self.k_num, self.hash_version)
         self.bitmap[size_offset:size_offset+self.K_NUM_LEN] = knum_str
         self.bitmap.flush()
 
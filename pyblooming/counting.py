@@ -0,0 +1,255 @@
+"""
+Implements a counting Bloom filter, which unlike the
+plain Bloom filter supports removing keys.
+"""
+import struct
+
+from bloom import BloomFilter, bitmaplib
+
+
+class CountingBloomFilter(BloomFilter):
+    # Identifies the serialized format, see tostring()
+    MAGIC = "CBF\x01"
+
+    # capacity, error rate, k num, hash version, count
+    HEADER_FMT = "<QdHHQ"
+    HEADER_LEN = struct.calcsize(HEADER_FMT)
+
+    # Counters are 4 bits wide and saturate, a saturated counter
+    # is never decremented again
+    COUNTER_MAX = 0xF
+
+    def __init__(self, capacity, probability):
+        """
+        Creates a new counting Bloom filter for the given capacity and
+        false positive probability. Every bit of the equivalent BloomFilter
+        is replaced by a 4 bit counter, so it takes 4 times the memory,
+        but keys can be removed with discard().
+
+        Only keys that have actually been added may be discarded, otherwise
+        the counters of other keys get decremented. Thus add() should be
+        called once per key, not on every sighting.
+        """
+        if capacity < 1: raise ValueError, "Bad value provided for capacity!"
+        if not 0 < probability < 1: raise ValueError, "Bad value provided for probability!"
+        self.capacity = capacity
+        self.probability = probability
+        size, self.k_num = self.params_for_capacity(capacity, probability)
+        self.bitmap_size = 8 * (size - self.extra_buffer())
+        self.hash_version = self.HASH_DOUBLE
+        self.offset = int(self.bitmap_size / self.k_num)
+        # two counters per byte, the even one in the high nibble
+        self.counters = bytearray((self.bitmap_size + 1) / 2)
+        self.count = 0
+        self.info = {} # Allows dynamic properties
+
+    def _get(self, pos):
+        "Returns the value of a counter"
+        byte_val = self.counters[pos >> 1]
+        if pos & 1:
+            return byte_val & 0xF
+        return byte_val >> 4
+
+    def _set(self, pos, val):
+        "Sets the value of a counter"
+        byte_val = self.counters[pos >> 1]
+        if pos & 1:
+            self.counters[pos >> 1] = (byte_val & 0xF0) | val
+        else:
+            self.counters[pos >> 1] = (byte_val & 0x0F) | (val << 4)
+
+    def _nibbles(self):
+        "Returns the counters as a NumPy array, or None"
+        numpy = getattr(bitmaplib, 'numpy', None)
+        if numpy is None:
+            return None
+        packed = numpy.frombuffer(self.counters, dtype=numpy.uint8)
+        nibbles = numpy.empty(2 * len(packed), dtype=numpy.int16)
+        nibbles[0::2] = packed >> 4
+        nibbles[1::2] = packed & 0xF
+        return nibbles
+
+    def _store_nibbles(self, nibbles):
+        "Packs a NumPy array of counters back into the buffer"
+        numpy = bitmaplib.numpy
+        packed = numpy.frombuffer(self.counters, dtype=numpy.uint8)
+        packed[:] = (nibbles[0::2] << 4) | nibbles[1::2]
+
+    def _adjust(self, positions, delta):
+        "Increments or decrements the counters at the given positions"
+        for pos in positions:
+            val = self._get(pos)
+            # saturated counters stay put in both directions
+            if val < self.COUNTER_MAX:
+                self._set(pos, max(0, min(self.COUNTER_MAX, val + delta)))
+
+    def _increment_many(self, positions):
+        """
+        Increments the counters at the given positions, with a single
+        pass over the counters if NumPy is available
+        """
+        nibbles = self._nibbles()
+        if nibbles is None:
+            return self._adjust(positions, 1)
+        numpy = bitmaplib.numpy
+        hits = numpy.bincount(numpy.asarray(positions, dtype=numpy.int64),
+                              minlength=len(nibbles))
+        hits = numpy.minimum(hits, self.COUNTER_MAX).astype(numpy.int16)
+        live = nibbles < self.COUNTER_MAX
+        nibbles[live] += hits[live]
+        numpy.clip(nibbles, 0, self.COUNTER_MAX, out=nibbles)
+        self._store_nibbles(nibbles)
+
+    def add(self, key, check_first=False):
+        "Add a key to the set"
+        if check_first and key in self: return False
+        self._adjust(self._bit_positions(key), 1)
+        self.count += 1
+        return True
+
+    def add_many(self, keys, check_first=False):
+        """
+        Adds a batch of keys to the set. Returns the number of
+        keys added.
+        """
+        if check_first:
+            seen = set()
+            unique = []
+            for key in keys:
+                if key not in seen:
+                    seen.add(key)
+                    unique.append(key)
+            keys = [key for key, found in zip(unique, self.contains_many(unique))
+                    if not found]
+        if keys:
+            self._increment_many(self._batch_positions(keys))
+        self.count += len(keys)
+        return len(keys)
+
+    def discard(self, key):
+        """
+        Removes a key from the set, if it is in it. Returns True if the
+        key was (possibly) in the set.
+        """
+        positions = self._bit_positions(key)
+        if not all(self._get(pos) for pos in positions): return False
+        self._adjust(positions, -1)
+        self.count = max(0, self.count - 1)
+        return True
+
+    def __contains__(self, key):
+        "Checks if the set contains a given key"
+        for pos in self._bit_positions(key):
+            if self._get(pos) == 0: return False
+        return True
+
+    def contains_many(self, keys):
+        """
+        Checks a batch of keys against the set. Returns a list of
+        booleans in the same order as the keys.
+        """
+        return [key in self for key in keys]
+
+    def to_bloom(self):
+        """
+        Returns a plain BloomFilter with a bit set for every non-zero
+        counter. It answers membership queries identically, using a
+        quarter of the memory.
+        """
+        size = self.bitmap_size / 8 + self.extra_buffer()
+        bf = BloomFilter(bitmaplib.Bitmap(size), self.k_num,
+                         hash_version=self.hash_version)
+        nibbles = self._nibbles()
+        if nibbles is not None:
+            bf.bitmap.set_many(bitmaplib.numpy.flatnonzero(nibbles[:self.bitmap_size]))
+        else:
+            bf.bitmap.set_many([pos for pos in xrange(self.bitmap_size)
+                                if self._get(pos)])
+        bf.count = self.count
+        return bf
+
+    def _merge(self, other, op):
+        """
+        Returns a new filter with the counters of both filters combined
+        with the given operator, which is applied to the NumPy arrays of
+        the counters or to each pair of counters.
+        """
+        self._check_compatible(other)
+        cbf = CountingBloomFilter(self.capacity, self.probability)
+        mine, theirs = self._nibbles(), other._nibbles()
+        if mine is not None:
+            merged = bitmaplib.numpy.clip(op(mine, theirs), 0, self.COUNTER_MAX)
+            cbf._store_nibbles(merged.astype(bitmaplib.numpy.int16))
+        else:
+            for pos in xrange(self.bitmap_size):
+                cbf._set(pos, max(0, min(self.COUNTER_MAX,
+                                         op(self._get(pos), other._get(pos)))))
+        cbf.count = int(round(cbf.estimate_cardinality()))
+        return cbf
+
+    def union(self, other):
+        """
+        Returns a new filter containing the keys of both filters, as if
+        they had been added to one filter. The counters are summed (and
+        saturate), so discarding a key removes one of its additions.
+        """
+        return self._merge(other, lambda a, b: a + b)
+
+    def intersection(self, other):
+        """
+        Returns a new filter containing (approximately) the keys found in
+        both filters. Each counter is the smaller of the two.
+        """
+        numpy = getattr(bitmaplib, 'numpy', None)
+        if numpy is not None:
+            return self._merge(other, numpy.minimum)
+        return self._merge(other, min)
+
+    def estimate_cardinality(self):
+        """
+        Estimates the number of distinct keys in the filter from the
+        number of non-zero counters.
+        """
+        nibbles = self._nibbles()
+        if nibbles is not None:
+            set_bits = int(bitmaplib.numpy.count_nonzero(nibbles[:self.bitmap_size]))
+        else:
+            set_bits = sum(1 for pos in xrange(self.bitmap_size)
+                           if self._get(pos))
+        return self._cardinality(set_bits)
+
+    def flush(self):
+        pass
+
+    def close(self, flush=True):
+        self.counters = None
+
+    def tostring(self):
+        """
+        Serializes the filter into a byte string: the magic prefix,
+        a header with the filter parameters and the counters.
+        """
+        return self.MAGIC \
+               + struct.pack(self.HEADER_FMT,
+                             self.capacity,
+                             self.probability,
+                             self.k_num,
+                             self.hash_version,
+                             self.count) \
+               + str(self.counters)
+
+    @classmethod
+    def fromstring(cls, data):
+        "Restores a filter serialized with tostring()"
+        if not (data and data.startswith(cls.MAGIC)): raise ValueError, "Not a counting Bloom filter!"
+        offset = len(cls.MAGIC)
+        capacity, probability, k_num, hash_version, count = \
+            struct.unpack_from(cls.HEADER_FMT, data, offset)
+        offset += cls.HEADER_LEN
+        cbf = cls(capacity, probability)
+        if (cbf.k_num, cbf.hash_version) != (k_num, hash_version): raise ValueError, "Incompatible filter parameters!"
+        counters = data[offset:]
+        if len(counters) != len(cbf.counters): raise ValueError, "Truncated counter data!"
+        cbf.counters[:] = counters
+        cbf.count = count
+        return cbf
@@ -0,0 +1,217 @@
+"""
+Implements a scalable Bloom filter that grows by adding
+layers of plain Bloom filters as more keys are added.
+"""
+import struct
+
+from bloom import BloomFilter, bitmaplib
+
+
+class ScalableBloomFilter(object):
+    # Identifies the serialized format, see tostring()
+    MAGIC = "SBF\x01"
+
+    # initial capacity, error rate, growth factor, tightening ratio, layers
+    HEADER_FMT = "<QdHdH"
+    HEADER_LEN = struct.calcsize(HEADER_FMT)
+
+    # capacity, error rate and byte length of each layer
+    LAYER_FMT = "<QdI"
+    LAYER_LEN = struct.calcsize(LAYER_FMT)
+
+    def __init__(self, initial_capacity=10000, error_rate=.01,
+                 growth=2, ratio=.5):
+        """
+        Creates a new scalable Bloom filter. Keys are added to the newest
+        layer until it reaches its capacity, after which a new layer with
+        `growth` times the capacity and `ratio` times the error rate is
+        added. The error rates form a geometric series, so the compound
+        false positive probability stays below `error_rate`.
+
+        :Parameters:
+          - initial_capacity (optional) : Capacity of the first layer.
+          - error_rate (optional) : The upper bound for the false positive
+            probability of the whole filter.
+          - growth (optional) : The capacity multiplier of each new layer.
+            Must be at least 1.
+          - ratio (optional) : The error rate multiplier of each new layer.
+            Must be between 0 and 1.
+        """
+        if initial_capacity < 1: raise ValueError, "Bad value provided for initial_capacity!"
+        if not 0 < error_rate < 1: raise ValueError, "Bad value provided for error_rate!"
+        if growth < 1: raise ValueError, "Bad value provided for growth!"
+        if not 0 < ratio < 1: raise ValueError, "Bad value provided for ratio!"
+        self.initial_capacity = initial_capacity
+        self.error_rate = error_rate
+        self.growth = growth
+        self.ratio = ratio
+        # list of (capacity, probability, BloomFilter)
+        self.layers = []
+        self.info = {} # Allows dynamic properties
+
+    @classmethod
+    def seeded(cls, bf, capacity, probability, growth=2, ratio=.5):
+        """
+        Creates a scalable filter whose first layer is an existing
+        BloomFilter, built for the given capacity and probability. The
+        further layers continue the same series of capacities and error
+        rates.
+        """
+        sbf = cls(capacity, probability / (1 - ratio), growth, ratio)
+        sbf.layers.append((capacity, probability, bf))
+        return sbf
+
+    def _add_layer(self):
+        "Adds a new, empty layer and returns it"
+        n = len(self.layers)
+        capacity = self.initial_capacity * self.growth ** n
+        prob = self.error_rate * (1 - self.ratio) * self.ratio ** n
+        bf = BloomFilter.for_capacity(capacity, prob)
+        self.layers.append((capacity, prob, bf))
+        return bf
+
+    def _writable_layer(self):
+        "Returns the newest layer, adding one if it is at capacity"
+        if self.layers:
+            capacity, prob, bf = self.layers[-1]
+            if bf.count < capacity:
+                return bf
+        return self._add_layer()
+
+    @property
+    def count(self):
+        "The number of keys added to all layers"
+        return sum(bf.count for c, p, bf in self.layers)
+
+    @property
+    def capacity(self):
+        "The total capacity of the current layers"
+        return sum(c for c, p, bf in self.layers)
+
+    def add(self, key, check_first=False):
+        "Add a key to the set"
+        if check_first and key in self: return False
+        self._writable_layer().add(key)
+        return True
+
+    def add_many(self, keys, check_first=False):
+        """
+        Adds a batch of keys to the set, filling up the newest layer
+        before adding another. Returns the number of keys added.
+        """
+        if check_first:
+            seen = set()
+            unique = []
+            for key in keys:
+                if key not in seen:
+                    seen.add(key)
+                    unique.append(key)
+            keys = [key for key, found in zip(unique, self.contains_many(unique))
+                    if not found]
+        added = 0
+        while added < len(keys):
+            bf = self._writable_layer()
+            capacity = self.layers[-1][0]
+            room = capacity - bf.count
+            added += bf.add_many(keys[added:added + room])
+        return added
+
+    def __contains__(self, key):
+        "Checks if the set contains a given key"
+        # the newest layers are the largest ones
+        for capacity, prob, bf in reversed(self.layers):
+            if key in bf: return True
+        return False
+
+    def contains_many(self, keys):
+        """
+        Checks a batch of keys against the set. Returns a list of
+        booleans in the same order as the keys.
+        """
+        found = [False] * len(keys)
+        for capacity, prob, bf in reversed(self.layers):
+            missing = [n for n, f in enumerate(found) if not f]
+            if not missing:
+                break
+            in_layer = bf.contains_many([keys[n] for n in missing])
+            for n, f in zip(missing, in_layer):
+                if f:
+                    found[n] = True
+        return found
+
+    def __len__(self):
+        "Returns the number of elements in the filter"
+        return self.count
+
+    def union(self, other):
+        """
+        Returns a new filter containing the keys of both filters. Layers
+        with the same capacity and error rate are merged, the others are
+        copied, so the false positive rate may exceed the error rate of
+        either filter. Keys added later go to the layers after them.
+        """
+        if (self.initial_capacity, self.error_rate, self.growth, self.ratio) \
+           != (other.initial_capacity, other.error_rate, other.growth, other.ratio):
+            raise ValueError, "Incompatible filter parameters!"
+        sbf = ScalableBloomFilter(self.initial_capacity, self.error_rate,
+                                  self.growth, self.ratio)
+        theirs = list(other.layers)
+        for capacity, prob, bf in self.layers:
+            match = [n for n, (c, p, obf) in enumerate(theirs)
+                     if (c, p, obf.bitmap_size, obf.k_num, obf.hash_version)
+                        == (capacity, prob, bf.bitmap_size, bf.k_num,
+                            bf.hash_version)]
+            if match:
+                c, p, obf = theirs.pop(match[0])
+                bf = bf.union(obf)
+            else:
+                bf = BloomFilter.fromstring(bf.tostring())
+            sbf.layers.append((capacity, prob, bf))
+        for capacity, prob, bf in theirs:
+            sbf.layers.append((capacity, prob, BloomFilter.fromstring(bf.tostring())))
+        # the layers are kept ordered by capacity, the largest last
+        sbf.layers.sort(key=lambda (c, p, bf): c)
+        return sbf
+
+    def tostring(self):
+        """
+        Serializes the filter into a byte string. The format is the magic
+        prefix, a header with the filter parameters, and the parameters
+        and bitmap of each layer.
+        """
+        parts = [self.MAGIC,
+                 struct.pack(self.HEADER_FMT,
+                             self.initial_capacity,
+                             self.error_rate,
+                             self.growth,
+                             self.ratio,
+                             len(self.layers))]
+        for capacity, prob, bf in self.layers:
+            data = bf.bitmap_string()
+            parts.append(struct.pack(self.LAYER_FMT, capacity, prob, len(data)))
+            parts.append(data)
+        return "".join(parts)
+
+    @classmethod
+    def is_serialized(cls, data):
+        "Checks if the given bytes were produced by tostring()"
+        return bool(data) and data.startswith(cls.MAGIC)
+
+    @classmethod
+    def fromstring(cls, data):
+        "Restores a filter serialized with tostring()"
+        if not cls.is_serialized(data): raise ValueError, "Not a scalable Bloom filter!"
+        offset = len(cls.MAGIC)
+        initial_capacity, error_rate, growth, ratio, num_layers = \
+            struct.unpack_from(cls.HEADER_FMT, data, offset)
+        offset += cls.HEADER_LEN
+        sbf = cls(initial_capacity, error_rate, growth, ratio)
+        for n in xrange(num_layers):
+            capacity, prob, length = struct.unpack_from(cls.LAYER_FMT, data, offset)
+            offset += cls.LAYER_LEN
+            bitmap = bitmaplib.Bitmap.fromstring(data[offset:offset + length])
+            offset += length
+            if len(bitmap) != 8 * length: raise ValueError, "Truncated layer data!"
+            size, ideal_k = BloomFilter.params_for_capacity(capacity, prob)
+            sbf.layers.append((capacity, prob, BloomFilter(bitmap, ideal_k)))
+        return sbf
@@ -0,0 +1,57 @@
+"""Needs the App Engine SDK in PYTHONPATH, run from the project root with e.g.
+
+    PYTHONPATH=~/google_appengine python -m unittest discover -s tests -t .
+"""
+import os
+import unittest
+
+import dev_appserver
+dev_appserver.fix_sys_path()
+
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb, testbed
+
+from bench import load_fixture
+from wnr import hk
+from wnr.extract import item_markers
+from wnr.models import IndexedUrls
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class ScrapeItemTest(unittest.TestCase):
+    def setUp(self):
+        self.tb = testbed.Testbed()
+        self.tb.activate()
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+        self.tb.init_datastore_v3_stub(consistency_policy=policy)
+        self.tb.init_memcache_stub()
+        self.tb.init_search_stub()
+        # for queue.yaml
+        self.tb.init_taskqueue_stub(root_path=ROOT)
+        ndb.get_context().set_cache_policy(False)
+
+    def tearDown(self):
+        self.tb.deactivate()
+
+    def scrape(self, fixture):
+        html = load_fixture(fixture).decode('utf-8')
+        url = dict(item_markers(html).og)['url']
+        hk.scrape_item(url, html)
+        IndexedUrls.apply_queued(hk._store.id)
+        return url
+
+    def test_indexes_item_url(self):
+        IndexedUrls.rebuild(hk._store.id)
+        url = self.scrape('item-1.html')
+
+        ent = IndexedUrls.load(hk._store.id)
+        cbf = ent.get_filter()
+        self.assertIn(ent.salt_url(url), cbf)
+        # not the URL of the last breadcrumb
+        self.assertEqual(cbf.count, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,199 @@
+"""The categories as a few flat arrays instead of a dict of tuples, so that
+the table is cheap to load from memcache and keep in memory.
+
+The rows are sorted by category ID, for lookups by bisection. The columns
+are the IDs, the row index of the parent (-1 for none) and the store and
+title as indexes to a pool of the distinct strings, which are stored once
+each in one UTF-8 buffer. The path of each category, as row indexes from
+the root, is precomputed into one more array.
+"""
+from array import array
+from bisect import bisect_left
+import struct
+
+
+VERSION = 2
+
+# version, rows, strings, path rows
+_header = struct.Struct("<BIII")
+
+# the 64 bit datastore IDs
+_id_type = 'l'
+assert array(_id_type).itemsize == 8
+
+
+class CategoryTable(object):
+    def __init__(self, ids, parents, stores, titles, offsets, path_starts,
+                 path_rows, pool):
+        self.ids = ids
+        self.parents = parents
+        self.stores = stores
+        self.titles = titles
+        # string n is pool[offsets[n]:offsets[n + 1]]
+        self.offsets = offsets
+        # the path of row n is path_rows[path_starts[n]:path_starts[n + 1]]
+        self.path_starts = path_starts
+        self.path_rows = path_rows
+        self.pool = pool
+        # see children()
+        self._child_rows = None
+
+    @classmethod
+    def build(cls, rows):
+        """Builds the table of (id, store, title, parent ID) rows. Parents
+        not in the table are dropped.
+        """
+        rows = sorted(rows)
+        ids = array(_id_type, (r[0] for r in rows))
+        index = {cat_id: n for n, cat_id in enumerate(ids)}
+        strings, string_index = [], {}
+
+        def intern(s):
+            n = string_index.get(s)
+            if n is None:
+                n = string_index[s] = len(strings)
+                strings.append(s.encode('utf-8'))
+            return n
+
+        parents = array('i', (index.get(r[3], -1) for r in rows))
+        stores = array('i', (intern(r[1]) for r in rows))
+        titles = array('i', (intern(r[2]) for r in rows))
+        offsets = array('i', [0])
+        for s in strings:
+            offsets.append(offsets[-1] + len(s))
+        path_starts, path_rows = _paths(parents)
+        return cls(ids, parents, stores, titles, offsets,
+                   path_starts, path_rows, "".join(strings))
+
+    def tostring(self):
+        return _header.pack(VERSION,
+                            len(self.ids),
+                            len(self.offsets) - 1,
+                            len(self.path_rows)) \
+               + self.ids.tostring() \
+               + self.parents.tostring() \
+               + self.stores.tostring() \
+               + self.titles.tostring() \
+               + self.offsets.tostring() \
+               + self.path_starts.tostring() \
+               + self.path_rows.tostring() \
+               + self.pool
+
+    @classmethod
+    def fromstring(cls, data):
+        version = ord(data[0])
+        if version != VERSION:
+            raise ValueError("Unknown category table version %d" % version)
+        version, rows, strings, path_rows = _header.unpack_from(data)
+        columns, offset = [], _header.size
+        for typecode, count in ((_id_type, rows),
+                                ('i', rows),
+                                ('i', rows),
+                                ('i', rows),
+                                ('i', strings + 1),
+                                ('i', rows + 1),
+                                ('i', path_rows)):
+            column = array(typecode)
+            size = column.itemsize * count
+            column.fromstring(buffer(data, offset, size))
+            columns.append(column)
+            offset += size
+        return cls(*columns + [data[offset:]])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __contains__(self, cat_id):
+        return self._row(cat_id) >= 0
+
+    def _row(self, cat_id):
+        n = bisect_left(self.ids, cat_id)
+        if n < len(self.ids) and self.ids[n] == cat_id:
+            return n
+        return -1
+
+    def _string(self, n):
+        return self.pool[self.offsets[n]:self.offsets[n + 1]].decode('utf-8')
+
+    def _get(self, n):
+        parent = self.parents[n]
+        return (self._string(self.stores[n]),
+                self._string(self.titles[n]),
+                self.ids[parent] if parent >= 0 else None)
+
+    def get(self, cat_id, default=None):
+        "Returns (store, title, parent ID)"
+        n = self._row(cat_id)
+        if n < 0:
+            return default
+        return self._get(n)
+
+    def title(self, cat_id):
+        n = self._row(cat_id)
+        if n < 0:
+            raise KeyError(cat_id)
+        return self._string(self.titles[n])
+
+    def iteritems(self):
+        for n, cat_id in enumerate(self.ids):
+            yield cat_id, self._get(n)
+
+    def path(self, cat_id):
+        "Returns the IDs from the root category to `cat_id`"
+        n = self._row(cat_id)
+        if n < 0:
+            raise KeyError(cat_id)
+        rows = self.path_rows[self.path_starts[n]:self.path_starts[n + 1]]
+        return [self.ids[row] for row in rows]
+
+    def children(self, cat_id=None):
+        "Returns the IDs of the child categories, or the root categories"
+        if cat_id is None:
+            n = -1
+        else:
+            n = self._row(cat_id)
+            if n < 0:
+                raise KeyError(cat_id)
+        if self._child_rows is None:
+            self._index_children()
+        starts, rows = self._child_rows
+        return [self.ids[row] for row in rows[starts[n + 1]:starts[n + 2]]]
+
+    def _index_children(self):
+        # counting sort of the rows by parent, the roots first
+        starts = array('i', [0]) * (len(self.ids) + 2)
+        for parent in self.parents:
+            starts[parent + 2] += 1
+        for n in xrange(1, len(starts)):
+            starts[n] += starts[n - 1]
+        rows = array('i', [0]) * len(self.ids)
+        fill = array('i', starts)
+        for n, parent in enumerate(self.parents):
+            rows[fill[parent + 1]] = n
+            fill[parent + 1] += 1
+        self._child_rows = (starts, rows)
+
+
+def _paths(parents):
+    "Returns (path_starts, path_rows) for the parent row indexes"
+    paths = [None] * len(parents)
+    for n in xrange(len(parents)):
+        # up to a row with a known path
+        chain = []
+        row = n
+        while row >= 0 and paths[row] is None and row not in chain:
+            chain.append(row)
+            row = parents[row]
+        # or to the root, or to a cycle, which is cut here
+        path = paths[row] if row >= 0 and paths[row] is not None else ()
+        for row in reversed(chain):
+            path = paths[row] = path + (row,)
+
+    starts, rows = array('i', [0]), array('i')
+    for path in paths:
+        rows.extend(path)
+        starts.append(len(rows))
+    return starts, rows
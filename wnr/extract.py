@@ -0,0 +1,139 @@
+"""Single pass extraction of the markers that scrape_item() and
+scrape_category() need from HobbyKing pages. All the markers are
+alternatives of one pattern, so the page is scanned once instead of once
+per marker.
+
+The alternatives are anchored on an "e" that each of the markers contains
+at a fixed offset, followed by the next character of the marker. This keeps
+the scan on the regex engine's fast path, which only applies to patterns
+starting with a literal. The text before the anchor is checked with a
+lookbehind.
+"""
+from collections import namedtuple
+import re
+
+
+ItemMarkers = namedtuple('ItemMarkers', (
+    # lists of (name, content)
+    'itemprops', 'og',
+    # first matches, or None
+    'oro_currency', 'oro_product', 'button_sku', 'google_tag_params',
+    'title', 'breadcrumbs',
+    # list of product ID strings
+    'product_ids'))
+
+CategoryLinks = namedtuple('CategoryLinks', ('items', 'next_page', 'brands'))
+
+
+_item_markers = re.compile(
+    r'e(?:'
+    r'm(?<=item)prop="(?P<itemprop>[^"]+)" content="(?P<itemprop_value>[^"]*)"'
+    r'|r(?<=proper)ty="og:(?P<og>[^"]+)" content="(?P<og_value>[^"]*)"'
+    # the oroGTM( prefix has no "e", see _oro_gtm
+    r'|n(?<=","curren)cy":"(?P<oro_currency>[^"]+)"'
+    # greedy till the end of the line, as the product JSON may nest
+    r'|g(?<=oro_gtm\.reg)Product\((?=(?P<oro_id>\d+),(?P<oro_data>\{.+\})\);)'
+    r'|=(?<=<button type=)"submit" id="btn-sticky-bar-[^"]*" title="Buy now"'
+    r' class="button btn-cart" data-product-sku *= *"(?P<button_sku>[^"]+)"'
+    r'|=(?<=<input type=)"hidden" name="product" value="(?P<product_input>\d+)"'
+    r'|_(?<=google_)tag_params = *\{(?P<google_tag_params>[^}]*)\}'
+    # the spans which may contain other markers are only looked ahead at,
+    # so that the search goes on inside them
+    r'|>(?<=<title>)(?=(?P<title>[\s\S]+?)</title>)'
+    r'|a(?<=class="brea)dcrumbsPos"(?=(?P<breadcrumbs>[\s\S]*?)</ul>)'
+    r'| (?<=product_value )= (?P<product_value>\d+);'
+    r')')
+
+_oro_gtm = re.compile(r'oroGTM\(\'gtm\',\{"id":"[^"]*","curr\Z')
+
+_breadcrumb = re.compile(r'<a href="(.+?)".*?><.+?>(.+?)</')
+
+
+def item_markers(html):
+    itemprops, og, product_ids = [], [], []
+    first = dict.fromkeys(('oro_currency', 'oro_product', 'button_sku',
+                           'google_tag_params', 'title', 'breadcrumbs'))
+
+    def once(name, value):
+        if first[name] is None:
+            first[name] = value
+
+    for m in _item_markers.finditer(html):
+        kind = m.lastgroup
+        if kind == 'itemprop_value':
+            itemprops.append(m.group('itemprop', 'itemprop_value'))
+        elif kind == 'og_value':
+            og.append(m.group('og', 'og_value'))
+        elif kind == 'oro_currency':
+            if _oro_gtm.search(html, max(0, m.start() - 100), m.start()):
+                once(kind, m.group(kind))
+        elif kind == 'oro_data':
+            once('oro_product', m.group('oro_id', 'oro_data'))
+        elif kind in ('product_value', 'product_input'):
+            product_ids.append(m.group(kind))
+        elif kind == 'breadcrumbs':
+            once(kind, _breadcrumb.findall(m.group(kind)))
+        else:
+            once(kind, m.group(kind))
+
+    return ItemMarkers(itemprops=itemprops, og=og, product_ids=product_ids,
+                       **first)
+
+
+_category_markers = re.compile(
+    r'="(?:'
+    # the empty groups name the marker
+    r'p(?:(?<=id="p)roducts-list"(?P<list>)'
+    r'|(?<=class="p)roducts-grid(?P<grid>)'
+    r'|(?<=class="p)opularBrands(?P<brands>))'
+    r'|t(?<=class="t)oolbar-bottom(?P<toolbar>)'
+    r'|i(?<=<li class="i)tem(?P<item>)'
+    r'|b(?<=class="b)randImage(?P<brand_image>)'
+    r'|(?<=href=")(?P<next_page>[^"]+)" title="Next"'
+    r')')
+
+_href = re.compile(r'href="(.+?)"')
+
+
+def category_links(html):
+    """Works on offsets into `html`, which is preferably the undecoded
+    response body. Only the links are copied (and decoded).
+    """
+    def decode(url):
+        return url.decode('utf-8') if isinstance(url, str) else url
+
+    first, toolbars, items, brand_images = {}, [], [], []
+    next_page = None
+    for m in _category_markers.finditer(html):
+        kind = m.lastgroup
+        if kind == 'toolbar':
+            toolbars.append(m.start())
+        elif kind == 'item':
+            items.append(m.end())
+        elif kind == 'brand_image':
+            brand_images.append(m.start())
+        elif kind == 'next_page':
+            if next_page is None:
+                next_page = decode(m.group(kind))
+        elif kind not in first:
+            first[kind] = m.end()
+
+    # list format, or grid format
+    start = first.get('list', first.get('grid'))
+    if start is not None:
+        end = next((pos for pos in toolbars if pos > start), len(html))
+        items = [pos for pos in items if start < pos < end]
+        # the first link of each item
+        item_urls = [decode(_href.search(html, pos, next_pos).group(1))
+                     for pos, next_pos in zip(items, items[1:] + [end])]
+    else:
+        item_urls = None
+
+    brands = []
+    if 'brands' in first:
+        start = first['brands']
+        # till the last brand image
+        assert brand_images and brand_images[-1] > start
+        brands = map(decode, _href.findall(html, start, brand_images[-1]))
+
+    return CategoryLinks(items=item_urls, next_page=next_page, brands=brands)
@@ -0,0 +1,189 @@
+"""Crawl frontier stored as one entity per URL. URL entities are keyed by the
+URL hash under one of a few shard entities, so that enqueueing and
+deduplication are key lookups, and writes are spread over several entity
+groups. Completed URLs are kept (flagged done) until the crawl finishes, to
+deduplicate URLs found again later in the same crawl.
+"""
+from datetime import datetime, timedelta
+import hashlib
+import logging
+
+from google.appengine.api.datastore_errors import TransactionFailedError
+from google.appengine.ext import ndb
+
+
+class FrontierShard(ndb.Model):
+    """Entity group root, keyed by "<frontier id>:<shard #>"."""
+    pending = ndb.IntegerProperty(default=0)
+
+
+class FrontierUrl(ndb.Model):
+    """Keyed by the URL hash, FrontierShard as parent."""
+    frontier = ndb.StringProperty(required=True)
+    url = ndb.TextProperty(required=True)
+    url_type = ndb.StringProperty(required=True)
+    added = ndb.DateTimeProperty(auto_now_add=True)
+    # leasing moves this to the lease expiry time
+    available = ndb.DateTimeProperty(required=True)
+    attempts = ndb.IntegerProperty(default=0, indexed=False)
+    done = ndb.BooleanProperty(default=False)
+
+
+def url_hash(url):
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    return hashlib.sha1(url).hexdigest()
+
+
+class Frontier(object):
+    def __init__(self, frontier_id, shards=8):
+        self.id = frontier_id
+        self.shards = shards
+
+    def __repr__(self):
+        return "Frontier(%r)" % self.id
+
+    def _shard_keys(self):
+        return [ndb.Key(FrontierShard, "%s:%d" % (self.id, shard))
+                for shard in range(self.shards)]
+
+    def shard_key(self, url):
+        return self._shard_keys()[int(url_hash(url)[:8], 16) % self.shards]
+
+    def url_key(self, url_type, url):
+        # the same URL may be queued as different types
+        return ndb.Key(FrontierUrl, "%s:%s" % (url_type, url_hash(url)),
+                       parent=self.shard_key(url))
+
+    def enqueue(self, url_type, urls):
+        """Queues the URLs that haven't been queued before in this frontier,
+        and returns them.
+        """
+        by_shard = {}
+        for url in urls:
+            by_shard.setdefault(self.shard_key(url), []) \
+                    .append(url)
+
+        @ndb.transactional
+        def tx(shard_key, urls):
+            shard = shard_key.get() or FrontierShard(key=shard_key)
+            keys = [self.url_key(url_type, url) for url in urls]
+            now = datetime.utcnow()
+            new = [FrontierUrl(key=key,
+                               frontier=self.id,
+                               url=url,
+                               url_type=url_type,
+                               available=now)
+                   for key, url, ent in zip(keys, urls, ndb.get_multi(keys))
+                   if not ent]
+            if new:
+                shard.pending += len(new)
+                ndb.put_multi([shard] + new)
+            return [ent.url for ent in new]
+
+        queued = []
+        for shard_key, shard_urls in by_shard.iteritems():
+            queued += tx(shard_key, shard_urls)
+        if queued:
+            logging.debug("%r: queued %d %s URLs" % (self, len(queued), url_type))
+        return queued
+
+    def lease(self, url_types, lease_seconds=300, limit=1):
+        """Leases up to `limit` available URLs, preferring them in the order
+        of `url_types`. Returns a list of (url, url_type, attempts), where
+        attempts includes this lease. A URL is available again after
+        `lease_seconds` unless completed.
+        """
+        @ndb.transactional
+        def tx(key, now):
+            ent = key.get()
+            if not ent or ent.done or ent.available > now:
+                # leased by someone else after the query
+                return None
+            ent.available = now + timedelta(seconds=lease_seconds)
+            ent.attempts += 1
+            ent.put()
+            return ent
+
+        leased = []
+        for url_type in url_types:
+            if len(leased) >= limit:
+                break
+            now = datetime.utcnow()
+            # eventually consistent, the leasing transaction re-checks
+            keys = FrontierUrl.query(FrontierUrl.frontier == self.id,
+                                     FrontierUrl.done == False,
+                                     FrontierUrl.url_type == url_type,
+                                     FrontierUrl.available <= now) \
+                              .order(FrontierUrl.available) \
+                              .fetch(limit - len(leased), keys_only=True)
+            for key in keys:
+                ent = tx(key, now)
+                if ent:
+                    leased.append((ent.url, ent.url_type, ent.attempts))
+        return leased
+
+    def complete(self, urls):
+        """Flags a batch of (url, url_type) done, in one transaction. Returns
+        the number of URLs that were pending.
+        """
+        # one entity group per shard
+        @ndb.transactional(xg=len({self.shard_key(url) for url, t in urls}) > 1)
+        def tx():
+            shards = {}
+            puts = []
+            keys = [self.url_key(url_type, url) for url, url_type in urls]
+            for ent in ndb.get_multi(keys):
+                if not ent or ent.done:
+                    continue
+                ent.done = True
+                puts.append(ent)
+                shard_key = ent.key.parent()
+                shards[shard_key] = shards.get(shard_key, 0) + 1
+            for shard in ndb.get_multi(shards.keys()):
+                shard.pending -= shards[shard.key]
+                puts.append(shard)
+            ndb.put_multi(puts)
+            return len(puts) - len(shards)
+        if not urls:
+            return 0
+        return tx()
+
+    def pending(self):
+        """Returns the number of URLs queued and not completed, from the
+        (strongly consistent) shard counters. The shards are read one by
+        one, so a URL queued to one shard while another one completes may
+        be missed, see drained().
+        """
+        return sum(shard.pending
+                   for shard in ndb.get_multi(self._shard_keys())
+                   if shard)
+
+    def drained(self):
+        """Checks that nothing is pending, from a snapshot of all the shard
+        counters. Returns False also if the snapshot can't be committed.
+        """
+        @ndb.transactional(xg=True, retries=0)
+        def tx():
+            return not any(shard.pending
+                           for shard in ndb.get_multi(self._shard_keys())
+                           if shard)
+        try:
+            return tx()
+        except TransactionFailedError:
+            return False
+
+    def delete(self):
+        """Deletes all entities of this frontier."""
+        query = FrontierUrl.query(FrontierUrl.frontier == self.id)
+        while True:
+            keys = query.fetch(500, keys_only=True)
+            if not keys:
+                break
+            ndb.delete_multi(keys)
+        ndb.delete_multi(self._shard_keys())
+        logging.info("%r: deleted" % self)
+
+
+def delete_frontier(frontier_id):
+    Frontier(frontier_id).delete()
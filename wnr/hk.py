@@ -1,28 +1,36 @@
 from datetime import datetime, timedelta
 from decimal import Decimal
+import hashlib
 import json
 import logging
 import os
 import re
 
 from google.appengine.api import taskqueue, urlfetch
+from google.appengine.api.apiproxy_stub_map import UserRPC
 from google.appengine.ext import deferred, ndb
 
 from HTMLParser import HTMLParser
 import webapp2
 
 from . import store_info
+from .extract import category_links, item_markers
 from .models import (
-    Category, Item, PAGE_TYPE, Price, ScrapeJob, SiteScan, Store, TableScan)
-from .search import index_items
-from .util import cacheize, get, nub, ok_resp, update_category_counts
+    Category, IndexedUrls, Item, ItemCountShard, PAGE_TYPE, PageValidator,
+    ScrapeJob, SiteScan, Store, TableScan, update_subtree_ancestors)
+from .search import queue_indexing, reindex_categories, schedule_indexing
+from .util import cacheize, get, nub, ok_resp
 
 
 _store = store_info('hk', "HobbyKing", "https://hobbyking.com/")
 
+# concurrent scrape tasks, see queue.yaml for the queue limit
+WORKERS = 5
+
+# URLs leased and fetched concurrently by a single task
+BATCH_SIZE = 10
+
 href = re.compile(r'href="(.+?)"')
-itemprop = re.compile(r'itemprop="(.+?)" content="(.+?)"')
-ogprop = re.compile(r'property="og:(.+?)" content="(.+?)"')
 
 
 class NoSKU(Exception):
@@ -38,12 +46,13 @@ def reindex_latest():
     new_run = SiteScan.initialize(_store.id, skip_indexed=False)
     SiteScan.queue(_store.id, items=urls)
     if new_run:
-        deferred.defer(process_queue, _queue='scrape', _countdown=2)
+        start_workers(countdown=2)
 
 
 def trigger_site_scan(rq):
     deferred.defer(queue_categories,
                    rescan='rescan' in rq.GET,
+                   workers=int(rq.GET.get('workers', WORKERS)),
                    _queue='scrape')
     return webapp2.Response()
 
@@ -51,11 +60,11 @@ def trigger_site_scan(rq):
 def trigger_table_scan(rq):
     assert TableScan.initialize(_store.id), \
         "Previous crawl still in progress"
-    deferred.defer(process_queue, _queue='scrape')
+    start_workers(int(rq.GET.get('workers', WORKERS)), countdown=0)
     return webapp2.Response()
 
 
-def queue_categories(rescan=False):
+def queue_categories(rescan=False, workers=WORKERS):
     if not SiteScan.initialize(_store.id, skip_indexed=not rescan):
         logging.warn("Previous crawl still in progress")
         return
@@ -77,7 +86,7 @@ def queue_categories(rescan=False):
 
     logging.debug("Found %d categories" % len(urls))
     SiteScan.queue(_store.id, categories=urls)
-    deferred.defer(process_queue, _queue='scrape', _countdown=1)
+    start_workers(workers)
 
 
 def cookie_value(cookies):
@@ -85,7 +94,23 @@ def cookie_value(cookies):
                      for cookie in cookies.itervalues())
 
 
-def scrape_page(url_type, url, cookies):
+def fetch_rpc(url, cookies, validator=None):
+    """`validator` is the PageValidator of the URL, if any, making the
+    request conditional.
+    """
+    headers = validator.request_headers() if validator else {}
+    if cookies:
+        headers['Cookie'] = cookie_value(cookies)
+    rpc = urlfetch.create_rpc(deadline=20)
+    urlfetch.make_fetch_call(rpc,
+                             url,
+                             headers=headers,
+                             follow_redirects=False)
+    return rpc
+
+
+def scrape_page(url_type, url, cookies, retries=None, rpc=None):
+    """`rpc` is an already started fetch of `url`, see fetch_rpc()."""
     def set_removed(url):
         queries = [Item.query(Item.url == url),
                    Category.query(Category.url == url)]
@@ -97,45 +122,66 @@ def scrape_page(url_type, url, cookies):
 
         @ndb.transactional
         def tx(key):
+            "Returns (entity, flagged removed now)"
             ent = key.get()
             if not ent.removed:
                 ent.removed = now
                 ent.put()
                 if isinstance(ent, Item):
-                    deferred.defer(index_items,
-                                   [ent.key],
-                                   _transactional=True,
-                                   _queue='indexing',
-                                   _countdown=2)
+                    queue_indexing([ent.key], transactional=True)
                 logging.warn("%r: flagged removed" % ent.key)
+                return ent, True
+            return ent, False
 
+        removed = []
         for key in keys:
-            tx(key)
-
-    retries = int(os.getenv('HTTP_X_APPENGINE_TASKRETRYCOUNT', 0))
-    headers = {}
+            ent, flagged = tx(key)
+            if isinstance(ent, Item):
+                # also if flagged already, in case counting failed then
+                ItemCountShard.count(ent, ent.category if flagged else None)
+                if flagged:
+                    removed.append(key)
+        for key in removed:
+            IndexedUrls.discard(_store.id, url)
+        if removed:
+            schedule_indexing()
+
+    def unexpected(rs, url):
+        body = rs.content.decode('utf-8', 'replace')
+        return taskqueue.TransientError(
+                   "%d for %s\nBody:\n%s\n\nHeaders:\n%r"
+                   % (rs.status_code,
+                      url,
+                      body.encode('ascii', 'xmlcharrefreplace')[:2000],
+                      rs.headers))
+
+    if retries is None:
+        retries = int(os.getenv('HTTP_X_APPENGINE_TASKRETRYCOUNT', 0))
 
     while True:
-        if cookies:
-            headers['Cookie'] = cookie_value(cookies)
-
-        rs = urlfetch.fetch(url,
-                            headers=headers,
-                            follow_redirects=False,
-                            deadline=20)
+        if not rpc:
+            rpc = fetch_rpc(url, cookies, PageValidator.key_for(url).get())
+        rs = rpc.get_result()
+        rpc = None
 
+        # also on 304s, which may renew the session
         cookie = rs.headers.get('Set-Cookie')
         if cookie:
             cookies.load(cookie)
 
-        content = rs.content.decode('utf-8')
+        if rs.status_code == 304:
+            not_modified(url_type, url)
+            break
+
         if url_type == PAGE_TYPE.ITEM:
             if rs.status_code == 200:
                 try:
-                    scrape_item(url, content)
+                    scrape_item(url, rs.content.decode('utf-8'))
                 except NoSKU:
                     logging.warn("Item page scraping error", exc_info=True)
                     set_removed(url)
+                else:
+                    PageValidator.save(url, rs.headers)
                 break
             elif rs.status_code in (301, 302):
                 redir = rs.headers['Location']
@@ -147,16 +193,14 @@ def scrape_page(url_type, url, cookies):
                 set_removed(url)
                 break
             else:
-                raise taskqueue.TransientError(
-                          "%d for %s\nBody:\n%s\n\nHeaders:\n%r"
-                          % (rs.status_code,
-                             url,
-                             content.encode('ascii', 'xmlcharrefreplace')[:2000],
-                             rs.headers))
+                raise unexpected(rs, url)
 
         elif url_type == PAGE_TYPE.CATEGORY:
             if rs.status_code == 200:
-                scrape_category(url, content)
+                # parsed from the raw bytes
+                cat_urls, item_urls = scrape_category(url, rs.content)
+                PageValidator.save(url, rs.headers,
+                                   {'categories': cat_urls, 'items': item_urls})
                 break
             elif rs.status_code in (301, 302):
                 redir = rs.headers['Location']
@@ -168,93 +212,127 @@ def scrape_page(url_type, url, cookies):
                 set_removed(url)
                 break
             else:
-                raise taskqueue.TransientError(
-                          "%d for %s\nBody:\n%s\n\nHeaders:\n%r"
-                          % (rs.status_code,
-                             url,
-                             content.encode('ascii', 'xmlcharrefreplace')[:2000],
-                             rs.headers))
+                raise unexpected(rs, url)
 
         else:
             raise ValueError("Unknown URL type %r" % (url_type,))
 
 
+def not_modified(url_type, url):
+    """Handles a 304 response to a conditional request."""
+    logging.info("Not modified: %s" % url)
+    validator = PageValidator.key_for(url).get()
+    if validator:
+        # just touching the checked timestamp, a small write unlike the item
+        validator.put()
+    if url_type == PAGE_TYPE.CATEGORY:
+        links = validator and validator.links
+        if links and SiteScan.in_progress(_store.id):
+            # found URLs again, deduplicated by the crawl
+            SiteScan.queue(_store.id,
+                           categories=links['categories'],
+                           items=links['items'])
+    elif url_type != PAGE_TYPE.ITEM:
+        raise ValueError("Unknown URL type %r" % (url_type,))
+
+
 def process_table_scan():
-    job = ndb.Key(TableScan, _store.id).get()
-    if not isinstance(job, TableScan):
-        return False
-    item = job.marker.get()
-    cookies = job.get_cookies()
-    scrape_page(PAGE_TYPE.ITEM, item.url, cookies)
-    marker = Item.query(Item.key > item.key) \
-                 .order(Item.key) \
-                 .get(keys_only=True)
-    logging.debug("Table scan advance %r -> %r" % (item.key, marker))
-    if marker and marker.parent() == item.key.parent():
-        TableScan.advance(_store.id, marker, cookies)
-    else:
-        TableScan.advance(_store.id, None, cookies)
+    """Returns True if an item was scraped, None if the scan is in progress
+    but there was nothing to lease, and False if there's no scan.
+    """
+    item_key, cookies = TableScan.lease(_store.id)
+    if not item_key:
+        return None if TableScan.in_progress(_store.id) else False
+    item = item_key.get()
+    if item:
+        scrape_page(PAGE_TYPE.ITEM, item.url, cookies)
+    TableScan.complete(_store.id, item_key, cookies)
     return True
 
 
 def process_site_scan():
-    queue_url, url_type, cookies = SiteScan.peek(_store.id)
-    if not queue_url:
-        return False
+    """See process_table_scan(). Leases a batch of URLs, fetches them
+    concurrently and scrapes them in the order the responses arrive.
+    """
+    leased, cookies = SiteScan.lease(_store.id, limit=BATCH_SIZE)
+    if not leased:
+        # URLs may be leased or not yet visible to the lease query
+        return None if SiteScan.in_progress(_store.id) else False
+
+    validators = ndb.get_multi([PageValidator.key_for(url)
+                                for url, url_type, attempts in leased])
+    rpcs = {fetch_rpc(url, cookies, validator): (url, url_type, attempts)
+            for (url, url_type, attempts), validator
+            in zip(leased, validators)}
+    done, waiting = [], rpcs.keys()
+    while waiting:
+        rpc = UserRPC.wait_any(waiting)
+        waiting.remove(rpc)
+        url, url_type, attempts = rpcs[rpc]
+        logging.info("Scraping %r" % url)
+        try:
+            scrape_page(url_type, url, cookies,
+                        retries=attempts - 1,
+                        rpc=rpc)
+        except Exception:
+            # leased again once the lease expires
+            logging.exception("Scraping %s failed" % url)
+        else:
+            done.append((url, url_type))
 
-    logging.info("Scraping %r" % queue_url)
-    scrape_page(url_type, queue_url, cookies)
-    SiteScan.pop(_store.id, queue_url, cookies)
+    SiteScan.complete(_store.id, done, cookies)
+    if not done:
+        raise taskqueue.TransientError("All %d URLs failed" % len(leased))
     return True
 
 
-def process_queue():
-    if process_site_scan() or process_table_scan():
-        deferred.defer(
-            process_queue,
-            _queue='scrape',
-            _countdown=1,
-            _retry_options=taskqueue.TaskRetryOptions(max_backoff_seconds=30))
-    else:
-        logging.info("Scrape finished")
-        deferred.defer(update_category_counts,
-                       store_id=_store.id,
+def start_workers(workers=WORKERS, countdown=1):
+    for worker in range(workers):
+        deferred.defer(process_queue,
+                       worker=worker,
                        _queue='scrape',
-                       _countdown=5)
-
-
-def scrape_category(url, html):
-    # list format
-    items = html.split('id="products-list"', 1)
-    if len(items) == 1:
-        # grid format
-        items = html.split('class="products-grid', 1)
-    if len(items) > 1:
-        items = items[1].split('class="toolbar-bottom', 1)[0] \
-                        .split('<li class="item')[1:]
-        item_urls = [href.search(item).group(1) for item in items]
-        logging.info("Found %d items" % len(item_urls))
+                       _countdown=countdown)
+
+
+def process_queue(worker=0):
+    state = process_site_scan()
+    if state is False:
+        state = process_table_scan()
+    if state is False:
+        # the post-crawl tasks are triggered by the finishing job
+        logging.info("Worker %d: scrape finished" % worker)
+        return
+    deferred.defer(
+        process_queue,
+        worker=worker,
+        _queue='scrape',
+        # back off while other workers hold all the leases
+        _countdown=1 if state else 5,
+        _retry_options=taskqueue.TaskRetryOptions(max_backoff_seconds=30))
+
+
+def scrape_category(url, content):
+    links = category_links(content)
+    if links.items is not None:
+        logging.info("Found %d items" % len(links.items))
+        item_urls = links.items
     else:
         logging.warn("No items found")
         item_urls = []
 
     cat_urls = []
 
-    npage = re.search(r'href="([^"]+)" title="Next"', html)
-    if npage:
-        cat_urls.append(npage.group(1))
+    if links.next_page:
+        cat_urls.append(links.next_page)
         logging.debug("Queuing next page %s" % (cat_urls,))
 
-    sub_cats = html.split('class="popularBrands', 1)
-    if len(sub_cats) > 1:
-        sub_cats = sub_cats[1].rsplit('class="brandImage', 1)
-        assert len(sub_cats) == 2
-        sub_cats = href.findall(sub_cats[0])
+    if links.brands:
         logging.debug("Found %d sub-categories:\n%s"
-                      % (len(sub_cats), "\n".join(sub_cats)))
-        cat_urls += sub_cats
+                      % (len(links.brands), "\n".join(links.brands)))
+        cat_urls += links.brands
 
     SiteScan.queue(_store.id, categories=cat_urls, items=item_urls)
+    return cat_urls, item_urls
 
 
 @cacheize(60 * 60)
@@ -274,12 +352,13 @@ def by_url(url):
 
 
 def save_cats(path):
-    from .views import get_categories
+    from .views import categories_changed
 
     @ndb.transactional
-    def update(cat_key, title, parent_cat):
+    def update(cat_key, title, parent_cat, ancestors):
+        "Returns (modified, moved)"
         cat = cat_key.get()
-        mod = False
+        mod = moved = False
         if cat.title != title:
             logging.warn("Renaming %r '%s' -> '%s'"
                          % (cat_key, cat.title, title))
@@ -288,74 +367,88 @@ def save_cats(path):
         if cat.parent_cat != parent_cat:
             logging.warn("Changing parent of %r %r -> %r"
                          % (cat_key, cat.parent_cat, parent_cat))
-            # this needs full item reindexing
-            assert parent_cat != cat.key
-            cat.parent_cat = parent_cat
-            mod = True
+            cat.set_parent(parent_cat, ancestors)
+            mod = moved = True
         if cat.removed:
             cat.removed = None
             mod = True
         if mod:
             cat.put()
-            return True
-        else:
-            return False
+        return mod, moved
 
-    ckeys, mod = [], False
+    ckeys, mod, moved = [], False, []
     for url, title in path:
         parent = ckeys[-1] if ckeys else None
+        # the path is saved from the root
+        ancestors = [ck.id() for ck in ckeys]
         try:
             cat_key, _title, _parent = by_url(url)
         except KeyError:
             cat = Category(store=_store.id,
                            title=title,
                            url=url,
-                           parent_cat=parent)
+                           parent_cat=parent,
+                           ancestors=ancestors)
             cat_key = cat.put()
             mod = True
         else:
-            if (title, parent) != (_title, _parent) \
-               and update(cat_key, title, parent):
-                by_url(url, _invalidate=True)
-                mod = True
+            if (title, parent) != (_title, _parent):
+                cat_mod, cat_moved = update(cat_key, title, parent, ancestors)
+                if cat_mod:
+                    by_url(url, _invalidate=True)
+                    mod = True
+                if cat_moved:
+                    update_subtree_ancestors(cat_key)
+                    moved.append(cat_key)
         ckeys.append(cat_key)
 
     if mod:
-        get_categories(store_id=_store.id, _invalidate=True)
-        get_categories(_invalidate=True)
+        categories_changed()
+
+    if moved:
+        # the category paths of the items below have changed
+        deferred.defer(reindex_categories, moved, _queue='indexing')
 
     return ckeys
 
 
+def fingerprint(sku, fields, price, cats):
+    """Digest of the scraped item data, to detect unchanged items."""
+    data = [sku,
+            fields['url'],
+            fields['title'],
+            fields['image'],
+            price,
+            cats,
+            (fields.get('custom') or {}).get('hk-id')]
+    return hashlib.sha1(json.dumps(data)).hexdigest()
+
+
 def scrape_item(url, html):
     h = HTMLParser()
+    markers = item_markers(html)
 
     def parse_oro():
-        cur = re.search(r'oroGTM\(\'gtm\',\{"id":".+?","currency":"(.+?)"', html)
+        cur = markers.oro_currency
         if cur:
             # just counting on the first entry to match... (which seems to
             # be the main item)
-            prod = re.search(r"oro_gtm.regProduct\((\d+),(\{.+\})\);", html)
+            prod = markers.oro_product
             if prod:
-                data = json.loads(prod.group(2), parse_float=Decimal)
+                data = json.loads(prod[1], parse_float=Decimal)
                 return {
-                    'id': int(prod.group(1)),
+                    'id': int(prod[0]),
                     'sku': data['id'],
-                    'price': (cur.group(1), data['price']),
+                    'price': (cur, data['price']),
                 }
         logging.warn("Failed to parse Oro data")
 
-    props = dict(itemprop.findall(html))
+    props = dict(markers.itemprops)
     oro = parse_oro()
-    og = dict(ogprop.findall(html))
+    og = dict(markers.og)
     logging.debug("itemprop: %r\noro: %r\nog: %r" % (props, oro, og))
 
-    def button_sku():
-        sku = re.search(r'<button type="submit" id="btn-sticky-bar-.+?" title="Buy now" class="button btn-cart" data-product-sku *= *"(.+?)"', html)
-        if sku:
-            return sku.group(1)
-
-    skus = {props.get('sku'), button_sku()}
+    skus = {props.get('sku'), markers.button_sku}
     if oro:
         skus.add(oro['sku'])
     skus.discard(None)
@@ -371,11 +464,11 @@ def scrape_item(url, html):
             return cur, Decimal(props['price'])
 
     def g_params_price():
-        g_params = re.search(r'google_tag_params = *\{(.*?)\}', html, re.DOTALL)
-        if g_params:
-            usd = re.search(r"value: '(.+?)'", g_params.group(1)).group(1)
+        g_params = markers.google_tag_params
+        if g_params is not None:
+            usd = re.search(r"value: '(.+?)'", g_params).group(1)
             logging.debug("google_tag_params: %s, usd: %s"
-                          % (g_params.group(1), usd))
+                          % (g_params, usd))
             return 'USD', Decimal(usd)
         else:
             logging.warn("Couldn't find google_tag_params")
@@ -395,9 +488,8 @@ def scrape_item(url, html):
     assert image
 
     def parse_title():
-        title = re.search(r"<title>(.+?)</title>", html, re.DOTALL)
-        if title:
-            return h.unescape(title.group(1)).strip()
+        if markers.title:
+            return h.unescape(markers.title).strip()
 
     # title isn't encoded properly in og props; priorize alternate source
     title = parse_title() or title
@@ -408,36 +500,23 @@ def scrape_item(url, html):
               'url': url,
               'removed': None}
 
-    cat_html = html.split('class="breadcrumbsPos"', 1)
-    if len(cat_html) > 1:
-        cat_html = cat_html[1].split('</ul>', 1)[0]
-        cats = re.findall(r'<a href="(.+?)".*?><.+?>(.+?)</', cat_html)
-    else:
-        cats = []
+    cats = markers.breadcrumbs or []
 
     if cats:
         assert len(cats) < 10 \
-               and not any("<" in name for url, name in cats), \
+               and not any("<" in name for cat_url, name in cats), \
             "Category scraping probably failed:\n%s" % (cats,)
-        cats = [(url, h.unescape(name).strip()) for url, name in cats]
+        # not `url`, which the list comprehension would overwrite
+        cats = [(cat_url, h.unescape(name).strip()) for cat_url, name in cats]
         logging.debug("Parsed categories:\n%s"
-                      % "\n".join("%s (%s)" % (name, url)
-                                  for url, name in cats))
-        cat_keys = save_cats(cats)
+                      % "\n".join("%s (%s)" % (name, cat_url)
+                                  for cat_url, name in cats))
     else:
         logging.warn("Couldn't find any categories")
-        cat_keys = save_cats([(_store.url, "(no category)")])
-
-    fields['category'] = cat_keys[-1]
+        cats = [(_store.url, "(no category)")]
 
     def prod_ids():
-        for prod_id in re.findall(r"product_value = (\d+);", html):
-            try:
-                yield int(prod_id)
-            except ValueError as e:
-                logging.warn(e, exc_info=True)
-
-        for prod_id in re.findall(r'<input type="hidden" name="product" value="(\d+)"', html):
+        for prod_id in markers.product_ids:
             try:
                 yield int(prod_id)
             except ValueError as e:
@@ -459,30 +538,40 @@ def scrape_item(url, html):
 
     key = ndb.Key(Store, _store.id, Item, sku)
     item = key.get()
+    fields['fingerprint'] = fingerprint(sku, fields, price, cats)
+    if item and not item.removed \
+       and item.fingerprint == fields['fingerprint']:
+        # checked as of the PageValidator saved by scrape_page()
+        logging.debug("%r: unchanged" % key)
+        return
+
+    fields['category'] = save_cats(cats)[-1]
+
     if item:
+        if item.removed:
+            IndexedUrls.add(_store.id, url)
+        elif item.url != url:
+            IndexedUrls.discard(_store.id, item.url)
+            IndexedUrls.add(_store.id, url)
+        prev_cat = None if item.removed else item.category
         item.populate(**fields)
-        puts = [item]
         if price:
-            p = Price.query(ancestor=item.key) \
-                     .order(-Price.timestamp) \
-                     .get()
-            if not (p and (p.currency, p.cents) == price):
-                puts.append(Price(parent=item.key,
-                                  currency=price[0],
-                                  cents=price[1]))
-            keys = ndb.put_multi(puts)
-            logging.debug("Updated %r" % (keys,))
+            item.add_price(*price)
+            # counted first, so that a failed put is retried with the next
+            # scrape, while counting again is a no-op
+            ItemCountShard.count(item, prev_cat)
+            item.put()
+            logging.debug("Updated %r" % key)
     else:
         item = Item(key=key, **fields)
-        puts = [item]
         if price:
-            puts.append(Price(parent=item.key,
-                              currency=price[0],
-                              cents=price[1]))
-        keys = ndb.put_multi(puts)
-        logging.debug("Added %r" % (keys,))
+            item.add_price(*price)
+        ItemCountShard.count(item, None)
+        item.put()
+        logging.debug("Added %r" % key)
+        IndexedUrls.add(_store.id, url)
 
-    index_items([item])
+    queue_indexing([key])
 
 
 def proxy(rq):
@@ -1,24 +1,32 @@
+from bisect import bisect_right
 from collections import namedtuple
 from Cookie import SimpleCookie
+from datetime import datetime, timedelta
+import json
 import logging
-from random import randint
+from random import randint, shuffle
 import time
 
-from google.appengine.api import memcache
+from google.appengine.api import memcache, taskqueue
 from google.appengine.api.datastore_errors import BadValueError
 from google.appengine.ext import deferred, ndb
 from google.appengine.ext.ndb import polymodel
 
 from pyblooming.bitmap import Bitmap
 from pyblooming.bloom import BloomFilter
+from pyblooming.counting import CountingBloomFilter
+from pyblooming.scalable import ScalableBloomFilter
 
-from . import get_stores
+from . import get_stores, priceseries
+from .frontier import delete_frontier, Frontier, url_hash
 
 
 """
 # test snippet for bloomfilter
 
 from pyblooming.bloom import BloomFilter
+from pyblooming.counting import CountingBloomFilter
+from pyblooming.scalable import ScalableBloomFilter
 from pyblooming.bitmap import Bitmap
 
 b = BloomFilter.for_capacity(100000, .01)
@@ -33,13 +41,11 @@ for x in range(20000, 40000):
   if str(x) in b:
     print x
 
-bloom_data = b.bitmap.mmap
+bloom_data = b.bitmap.tostring()
 print len(bloom_data)
 
 bytes, ideal_k = BloomFilter.params_for_capacity(100000, .01)
-bitmap = Bitmap(bytes)
-bitmap.mmap = bloom_data
-b = BloomFilter(bitmap, ideal_k)
+b = BloomFilter(Bitmap.fromstring(bloom_data), ideal_k)
 
 for x in range(20000):
   if str(x) not in b:
@@ -91,42 +97,110 @@ class ScrapeJob(polymodel.PolyModel):
         else:
             return SimpleCookie()
 
+    @classmethod
+    def in_progress(cls, store_id):
+        return isinstance(ndb.Key(cls, store_id).get(), cls)
+
+    @classmethod
+    @ndb.transactional
+    def save_cookies(cls, store_id, cookies):
+        job = ndb.Key(cls, store_id).get()
+        if isinstance(job, cls):
+            values = {cookie.key: cookie.value
+                      for cookie in cookies.itervalues()}
+            # avoiding a write per page
+            if values != (job.cookies or {}):
+                job.set_cookies(cookies)
+                job.put()
+
+    @classmethod
+    @ndb.transactional
+    def finish(cls, key, **kw):
+        """Deletes the job and triggers the post-crawl tasks, exactly once
+        even if several workers drain at the same time. `kw` must match the
+        job's properties, to not finish a newer job.
+        """
+        from .util import update_category_counts
+
+        job = key.get()
+        if not (isinstance(job, cls)
+                and all(getattr(job, k) == v for k, v in kw.iteritems())):
+            return False
+        job.key.delete()
+        logging.info("%r: crawl finished" % key)
+        deferred.defer(update_category_counts,
+                       store_id=key.id(),
+                       _transactional=True,
+                       _queue='scrape',
+                       _countdown=5)
+        return True
+
 
 class SiteScan(ScrapeJob):
-    category_queue = ndb.TextProperty(repeated=True)
-    item_queue = ndb.TextProperty(repeated=True)
-    # separating item and category blooms as there have been
-    # some item URL mixups
-    bloom_categories = ndb.BlobProperty(compressed=True)
+    # see frontier.py
+    frontier_id = ndb.StringProperty(required=True)
+    # URLs found indexed at the start of the crawl, skipped when queued
     bloom_items = ndb.BlobProperty(compressed=True)
     bloom_salt = ndb.IntegerProperty(required=True)
 
+    # items are scraped before categories
+    URL_PRIORITY = (PAGE_TYPE.ITEM, PAGE_TYPE.CATEGORY)
+
     @classmethod
     def initialize(cls, store_id, skip_indexed=True):
         """Returns True if a new crawl was initialized, and False if
         an earlier crawl was already in progress.
         """
         key = ndb.Key(cls, store_id)
-        salt = randint(1, 100000)
         if skip_indexed:
-            # using a throwaway entity
-            bf_items = cls(key=key, bloom_salt=salt).scan_indexed()
+            # the job shares the salt of the indexed URL filter so that
+            # its projection can serve as the first item bloom layer
+            indexed = IndexedUrls.load(store_id)
+            salt = indexed.bloom_salt
+            cbf = indexed.get_filter()
+            bf_items = ScalableBloomFilter.seeded(cbf.to_bloom(),
+                                                  cbf.capacity,
+                                                  cbf.probability)
         else:
+            salt = randint(1, 100000)
             bf_items = None
 
         @ndb.transactional
         def tx():
             if key.get():
                 return False
-            job = cls(key=key, bloom_salt=salt)
+            frontier_id = "%s-%s" % (store_id,
+                                     datetime.utcnow().strftime("%Y%m%d%H%M%S"))
+            job = cls(key=key, bloom_salt=salt, frontier_id=frontier_id)
             if bf_items:
-                job.bloom_items = bf_items.bitmap.mmap
+                job.bloom_items = bf_items.tostring()
             job.put()
             return True
         return tx()
 
+    def get_frontier(self):
+        return Frontier(self.frontier_id)
+
+    @classmethod
+    def restart_legacy(cls, store_id):
+        """Restarts a crawl started before the frontier, whose queued URLs
+        were in properties that don't exist anymore.
+        """
+        from .hk import queue_categories
+
+        @ndb.transactional
+        def tx():
+            job = ndb.Key(cls, store_id).get()
+            if isinstance(job, cls) and not job.frontier_id:
+                job.key.delete()
+                deferred.defer(queue_categories,
+                               _transactional=True,
+                               _queue='scrape')
+                logging.warn("%r: restarting a crawl without a frontier"
+                             % job.key)
+        tx()
+
     @classmethod
-    @ndb.transactional
     def queue(cls, store_id, categories=None, items=None):
         if not (categories or items):
             return
@@ -134,100 +208,129 @@ class SiteScan(ScrapeJob):
         key = ndb.Key(cls, store_id)
         job = key.get()
         assert isinstance(job, cls), "No crawl in progress"
-
-        def unseen(bf_data):
-            bf = cls.get_bloom(bf_data)
-            def inner(url):
-                if job.salt_url(url) in bf:
-                    logging.info("%r: skipping already seen URL %s" % (key, url))
-                    return False
-                else:
-                    return True
-            return inner
+        if not job.frontier_id:
+            # the restarted crawl finds the URLs again
+            cls.restart_legacy(store_id)
+            return
+        frontier = job.get_frontier()
 
         if categories:
-            categories = filter_urls(categories)
-            categories = filter(lambda url: url not in job.category_queue,
-                                categories)
-            categories = filter(unseen(job.bloom_categories), categories)
-            job.category_queue += categories
+            frontier.enqueue(PAGE_TYPE.CATEGORY, filter_urls(categories))
 
         if items:
             items = filter_urls(items)
-            items = filter(lambda url: url not in job.item_queue,
-                           items)
-            items = filter(unseen(job.bloom_items), items)
-            job.item_queue += items
-
-        job.put()
+            if job.bloom_items:
+                bf = cls.get_bloom(job.bloom_items)
+                seen = bf.contains_many(map(job.salt_url, items))
+                for url, is_seen in zip(items, seen):
+                    if is_seen:
+                        logging.info("%r: skipping already seen URL %s" % (key, url))
+                items = [url for url, is_seen in zip(items, seen) if not is_seen]
+            frontier.enqueue(PAGE_TYPE.ITEM, items)
 
     @classmethod
-    @ndb.transactional
-    def peek(cls, store_id):
+    def lease(cls, store_id, limit=1):
+        """Returns a list of leased (url, url_type, attempts), and the
+        cookies. The list is empty if there's nothing to lease at the
+        moment. Finishes the crawl if there's nothing pending either.
+        """
         job = ndb.Key(cls, store_id).get()
-        if isinstance(job, cls):
-            if job.item_queue:
-                return (job.item_queue[0],
-                        PAGE_TYPE.ITEM,
-                        job.get_cookies())
-            if job.category_queue:
-                return (job.category_queue[0],
-                        PAGE_TYPE.CATEGORY,
-                        job.get_cookies())
-        return None, None, None
+        if isinstance(job, cls) and not job.frontier_id:
+            cls.restart_legacy(store_id)
+        elif isinstance(job, cls):
+            frontier = job.get_frontier()
+            leased = frontier.lease(cls.URL_PRIORITY, limit=limit)
+            if leased:
+                return leased, job.get_cookies()
+            if not frontier.pending() and frontier.drained():
+                job.finish_crawl()
+        return [], None
 
     @classmethod
-    @ndb.transactional
-    def pop(cls, store_id, url, cookies):
+    def complete(cls, store_id, urls, cookies):
+        """Flags a list of (url, url_type) done."""
         job = ndb.Key(cls, store_id).get()
-        if not isinstance(job, cls):
+        if not (isinstance(job, cls) and job.frontier_id):
             return
-        def ne(_url):
-            return _url != url
-        mod = False
-        if url in job.category_queue:
-            job.category_queue = filter(ne, job.category_queue)
-            bf = job.get_bloom(job.bloom_categories)
-            bf.add(job.salt_url(url))
-            job.bloom_categories = bf.bitmap.mmap
-            mod = True
-        if url in job.item_queue:
-            job.item_queue = filter(ne, job.item_queue)
-            bf = job.get_bloom(job.bloom_items)
-            bf.add(job.salt_url(url))
-            job.bloom_items = bf.bitmap.mmap
-            mod = True
-        if not mod:
+        frontier = job.get_frontier()
+        if not frontier.complete(urls):
             return
-        if job.category_queue or job.item_queue:
-            job.set_cookies(cookies)
-            job.put()
+        if frontier.pending() or not frontier.drained():
+            cls.save_cookies(store_id, cookies)
         else:
-            job.key.delete()
+            job.finish_crawl()
+
+    def finish_crawl(self):
+        if self.finish(self.key, frontier_id=self.frontier_id):
+            deferred.defer(delete_frontier,
+                           self.frontier_id,
+                           _queue='scrape',
+                           _countdown=60)
 
     @classmethod
     def get_bloom(cls, bloom_data):
-        bloom_args = (100000, .01)
-        if bloom_data:
+        if ScalableBloomFilter.is_serialized(bloom_data):
+            bf = ScalableBloomFilter.fromstring(bloom_data)
+            logging.debug("get_bloom(): %d layers, %d/%d keys, data size %dkB"
+                          % (len(bf.layers), bf.count, bf.capacity,
+                             round(len(bloom_data) / 1024)))
+            return bf
+        elif BloomFilter.is_serialized(bloom_data):
+            return BloomFilter.fromstring(bloom_data)
+        elif bloom_data:
+            # fixed size filters of crawls started before scalable blooms
+            bloom_args = (100000, .01)
             size, ideal_k = BloomFilter.params_for_capacity(*bloom_args)
-            bitmap = Bitmap(size)
-            bitmap.mmap = bloom_data
-            return BloomFilter(bitmap, ideal_k)
+            assert len(bloom_data) == size, \
+                "Unexpected bloom data size %d" % len(bloom_data)
+            return BloomFilter(Bitmap.fromstring(bloom_data), ideal_k)
         else:
-            bf = BloomFilter.for_capacity(*bloom_args)
-            logging.debug("get_bloom(): data size %dkB"
-                          % round(len(bf.bitmap.mmap) / 1024))
-            return bf
+            return ScalableBloomFilter(initial_capacity=10000,
+                                       error_rate=.01)
+
+    def salt_url(self, url):
+        return str("%d$%s" % (self.bloom_salt, url))
+
+
+class IndexedUrls(ndb.Model):
+    """Deletable filter of the active item URLs of a store. Items are added
+    when first scraped (or restored) and discarded when flagged removed, so
+    a crawl doesn't need to scan all items to skip the indexed ones.
+    """
+    modified = ndb.DateTimeProperty(auto_now=True)
+    # set by rebuild() only, unlike `modified`
+    built = ndb.DateTimeProperty()
+    bloom = ndb.BlobProperty(compressed=True)
+    bloom_salt = ndb.IntegerProperty(required=True)
+
+    # rebuilt with a new salt periodically, so that a false positive
+    # doesn't skip the same new item forever
+    MAX_AGE = timedelta(days=7)
+
+    # URLs to add or discard, applied in batches by apply_queued()
+    PULL_QUEUE = 'indexed-urls'
+    BATCH = 500
+
+    def get_filter(self):
+        return CountingBloomFilter.fromstring(self.bloom)
 
     def salt_url(self, url):
         return str("%d$%s" % (self.bloom_salt, url))
 
-    def scan_indexed(self):
-        store_key = ndb.Key(Store, self.key.id())
+    @classmethod
+    def load(cls, store_id):
+        ent = ndb.Key(cls, store_id).get()
+        if ent and ent.built and ent.built > datetime.utcnow() - cls.MAX_AGE:
+            return ent
+        return cls.rebuild(store_id)
+
+    @classmethod
+    def rebuild(cls, store_id):
+        store_key = ndb.Key(Store, store_id)
         query = Item.query(Item.removed == None,
                            ancestor=store_key) \
                     .order(Item.url)
-        indexed = self.get_bloom(None)
+        urls = []
         # results in timeout without this kind of manual batch fetching
         batch = None
         while True:
@@ -238,14 +341,122 @@ class SiteScan(ScrapeJob):
             batch = q.fetch(500, projection=(Item.url,))
             if not batch:
                 break
-            for item in batch:
-                assert item.url
-                indexed.add(self.salt_url(item.url))
-        return indexed
+            assert all(item.url for item in batch)
+            urls += [item.url for item in batch]
+
+        ent = cls(key=ndb.Key(cls, store_id),
+                  built=datetime.utcnow(),
+                  bloom_salt=randint(1, 100000))
+        # leave room for growth, the filter is rebuilt when it fills up
+        cbf = CountingBloomFilter(max(2 * len(urls), 20000), .01)
+        cbf.add_many(map(ent.salt_url, urls))
+        ent.bloom = cbf.tostring()
+        ent.put()
+        logging.info("Rebuilt %r: %d URLs, data size %dkB"
+                     % (ent.key, cbf.count, round(len(ent.bloom) / 1024)))
+        return ent
+
+    @classmethod
+    @ndb.transactional
+    def _update(cls, store_id, changes):
+        "Applies a list of (url, add)"
+        ent = ndb.Key(cls, store_id).get()
+        if not ent:
+            # built on the next crawl
+            return
+        cbf = ent.get_filter()
+        for url, add in changes:
+            if add:
+                cbf.add(ent.salt_url(url))
+            else:
+                cbf.discard(ent.salt_url(url))
+        if cbf.count > cbf.capacity:
+            logging.info("%r is full, rebuilding on next crawl" % ent.key)
+            ent.key.delete()
+        else:
+            ent.bloom = cbf.tostring()
+            ent.put()
+
+    @classmethod
+    def _queue(cls, store_id, url, add):
+        # the filter is rewritten once per batch instead of once per URL,
+        # the parallel scrape workers would contend on it otherwise
+        taskqueue.Queue(cls.PULL_QUEUE).add(
+            taskqueue.Task(payload=json.dumps([url, add]),
+                           method='PULL',
+                           tag=store_id))
+        window = int(time.time() / 5)
+        try:
+            deferred.defer(apply_indexed_urls, store_id,
+                           _name="indexed-urls-%s-%d" % (store_id, window),
+                           _countdown=5,
+                           _queue='scrape')
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+
+    @classmethod
+    def add(cls, store_id, url):
+        cls._queue(store_id, url, add=True)
+
+    @classmethod
+    def discard(cls, store_id, url):
+        cls._queue(store_id, url, add=False)
+
+    @classmethod
+    def apply_queued(cls, store_id):
+        queue = taskqueue.Queue(cls.PULL_QUEUE)
+        while True:
+            tasks = queue.lease_tasks_by_tag(60, cls.BATCH, tag=store_id)
+            if not tasks:
+                break
+            try:
+                cls._update(store_id, [json.loads(task.payload)
+                                       for task in tasks])
+            except Exception:
+                # available again to the retry
+                for task in tasks:
+                    queue.modify_task_lease(task, 0)
+                raise
+            queue.delete_tasks(tasks)
+            if len(tasks) < cls.BATCH:
+                break
+
+
+def apply_indexed_urls(store_id):
+    IndexedUrls.apply_queued(store_id)
+
+
+class Lease(ndb.Model):
+    item = ndb.KeyProperty(kind='Item', required=True)
+    expires = ndb.DateTimeProperty(required=True)
+
+
+class TableScanShard(ndb.Model):
+    """Keyed by "<store id>:<shard #>". Leases the items with keys in
+    [marker, end), end None for the last shard.
+    """
+    # next item to lease, None once all have been leased
+    marker = ndb.KeyProperty(indexed=False)
+    end = ndb.KeyProperty(indexed=False)
+    leases = ndb.StructuredProperty(Lease, repeated=True)
+
+    def exhausted(self):
+        # final, as markers only advance and leases only end
+        return not (self.marker or self.leases)
 
 
 class TableScan(ScrapeJob):
-    marker = ndb.KeyProperty(required=True)
+    # the first keys of the shards but the first one
+    splits = ndb.KeyProperty(repeated=True, indexed=False)
+    shards = ndb.IntegerProperty(indexed=False)
+    # unsharded scans started before TableScanShard, see shard_keys()
+    marker = ndb.KeyProperty()
+    leases = ndb.StructuredProperty(Lease, repeated=True)
+
+    LEASE_SECONDS = 300
+
+    # the workers lease from random shards, not to contend on one entity
+    SHARDS = 8
 
     @classmethod
     def initialize(cls, store_id):
@@ -253,27 +464,188 @@ class TableScan(ScrapeJob):
         marker = Item.query(ancestor=store_key) \
                      .order(Item.key) \
                      .get(keys_only=True)
-        @ndb.transactional
+        # __scatter__ can't be combined with an ancestor in an index
+        sample = Item.query() \
+                     .order(ndb.GenericProperty('__scatter__')) \
+                     .fetch(cls.SHARDS * 32, keys_only=True)
+        sample = sorted(k for k in sample if k.parent() == store_key)
+        splits = sorted({sample[len(sample) * n / cls.SHARDS]
+                         for n in range(1, cls.SHARDS)
+                         if sample} - {marker})
+        key = ndb.Key(cls, store_id)
+
+        @ndb.transactional(xg=True)
         def tx():
-            key = ndb.Key(cls, store_id)
             if key.get():
                 return False
-            job = cls(key=key, marker=marker)
-            job.put()
+            job = cls(key=key, splits=splits, shards=len(splits) + 1)
+            shards = [TableScanShard(key=shard_key, marker=start, end=end)
+                      for shard_key, start, end
+                      in zip(job.shard_keys(),
+                             [marker] + splits,
+                             splits + [None])]
+            ndb.put_multi([job] + shards)
             return True
         return tx()
 
+    def shard_keys(self):
+        if self.shards is None:
+            # converted to one shard on the first lease
+            return [ndb.Key(TableScanShard, "%s:0" % self.key.id())]
+        return [ndb.Key(TableScanShard, "%s:%d" % (self.key.id(), n))
+                for n in range(self.shards)]
+
+    def shard_key(self, item_key):
+        return self.shard_keys()[bisect_right(self.splits, item_key)]
+
     @classmethod
-    @ndb.transactional
-    def advance(cls, store_id, marker, cookies):
-        job = ndb.Key(cls, store_id).get()
-        if isinstance(job, cls):
-            if marker:
-                job.marker = marker
-                job.set_cookies(cookies)
-                job.put()
-            else:
-                job.key.delete()
+    def _convert(cls, key):
+        @ndb.transactional(xg=True)
+        def tx():
+            job = key.get()
+            if isinstance(job, cls) and job.shards is None:
+                shard = TableScanShard(key=job.shard_keys()[0],
+                                       marker=job.marker,
+                                       leases=job.leases)
+                job.shards, job.marker, job.leases = 1, None, []
+                ndb.put_multi([job, shard])
+        tx()
+        return key.get()
+
+    @classmethod
+    def lease(cls, store_id):
+        """Returns (item key, cookies) of a leased item, or Nones if there's
+        nothing to lease at the moment. Expired leases are handed out again
+        before advancing the marker.
+        """
+        key = ndb.Key(cls, store_id)
+
+        @ndb.transactional
+        def tx(shard_key, marker, next_marker):
+            shard = shard_key.get()
+            now = datetime.utcnow()
+            expires = now + timedelta(seconds=cls.LEASE_SECONDS)
+            for lease in shard.leases:
+                if lease.expires < now:
+                    logging.warn("%r: lease of %r expired"
+                                 % (shard_key, lease.item))
+                    lease.expires = expires
+                    shard.put()
+                    return lease.item
+            if not shard.marker:
+                return None
+            if shard.marker != marker:
+                # advanced by another worker, retry
+                return False
+            shard.leases.append(Lease(item=marker, expires=expires))
+            shard.marker = next_marker
+            shard.put()
+            return marker
+
+        def lease_from(shard_key):
+            while True:
+                shard = shard_key.get()
+                marker = shard.marker
+                next_marker = None
+                if marker:
+                    next_marker = Item.query(Item.key > marker,
+                                             ancestor=marker.parent()) \
+                                      .order(Item.key) \
+                                      .get(keys_only=True)
+                    if next_marker and shard.end and next_marker >= shard.end:
+                        next_marker = None
+                item_key = tx(shard_key, marker, next_marker)
+                if item_key is not False:
+                    return item_key
+
+        job = key.get()
+        if isinstance(job, cls) and job.shards is None:
+            job = cls._convert(key)
+        if not isinstance(job, cls):
+            return None, None
+        shard_keys = job.shard_keys()
+        shuffle(shard_keys)
+        for shard_key in shard_keys:
+            item_key = lease_from(shard_key)
+            if item_key:
+                return item_key, job.get_cookies()
+        cls._finish_if_done(job)
+        return None, None
+
+    @classmethod
+    def complete(cls, store_id, item_key, cookies):
+        key = ndb.Key(cls, store_id)
+        job = key.get()
+        if isinstance(job, cls) and job.shards is None:
+            job = cls._convert(key)
+        if not isinstance(job, cls):
+            return
+
+        @ndb.transactional
+        def tx():
+            shard = job.shard_key(item_key).get()
+            shard.leases = [l for l in shard.leases if l.item != item_key]
+            shard.put()
+            return shard
+
+        if tx().exhausted():
+            cls._finish_if_done(job)
+        else:
+            cls.save_cookies(store_id, cookies)
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def finish(cls, key, **kw):
+        "Also deletes the shards, with the job so not those of a new scan"
+        job = key.get()
+        if not super(TableScan, cls).finish(key, **kw):
+            return False
+        ndb.delete_multi(job.shard_keys())
+        return True
+
+    @classmethod
+    def _finish_if_done(cls, job):
+        # the shards are read separately, which is safe as exhausted()
+        # doesn't change back
+        if all(shard.exhausted()
+               for shard in ndb.get_multi(job.shard_keys())):
+            cls.finish(job.key)
+
+
+class PageValidator(ndb.Model):
+    """HTTP validators of a scraped page, keyed by the URL hash. Category
+    pages also store the links found on them, to queue them again if the
+    page hasn't changed.
+    """
+    # when the page was last fetched, Item.checked is the last change
+    checked = ndb.DateTimeProperty(auto_now=True)
+    url = ndb.TextProperty(required=True)
+    etag = ndb.StringProperty(indexed=False)
+    last_modified = ndb.StringProperty(indexed=False)
+    links = ndb.JsonProperty(compressed=True)
+
+    @classmethod
+    def key_for(cls, url):
+        return ndb.Key(cls, url_hash(url))
+
+    @classmethod
+    def save(cls, url, headers, links=None):
+        etag, last_modified = map(headers.get, ('ETag', 'Last-Modified'))
+        # also without validators, for `checked`
+        cls(key=cls.key_for(url),
+            url=url,
+            etag=etag,
+            last_modified=last_modified,
+            links=links) \
+           .put()
+
+    def request_headers(self):
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
 
 
 class Category(ndb.Model):
@@ -282,8 +654,37 @@ class Category(ndb.Model):
     title = ndb.StringProperty(required=True)
     url = ndb.StringProperty(required=True)
     parent_cat = ndb.KeyProperty(kind='Category')
+    # IDs of the parent categories, the root first, for subtree queries
+    ancestors = ndb.IntegerProperty(repeated=True)
     removed = ndb.DateTimeProperty()
 
+    def set_parent(self, parent_key, ancestors):
+        """`ancestors` are those of the parent, followed by its ID. Raises
+        ValueError if the parent is a descendant.
+        """
+        if self.key and self.key.id() in ancestors:
+            raise ValueError("Moving %r under %r would make a cycle"
+                             % (self.key, parent_key))
+        self.parent_cat = parent_key
+        self.ancestors = ancestors
+
+
+def update_subtree_ancestors(cat_key):
+    "Updates the ancestors of the descendants after moving a category"
+    cat = cat_key.get()
+    prefix = cat.ancestors + [cat_key.id()]
+    puts = []
+    for desc in Category.query(Category.ancestors == cat_key.id()):
+        pos = desc.ancestors.index(cat_key.id())
+        ancestors = prefix + desc.ancestors[pos + 1:]
+        if desc.ancestors != ancestors:
+            desc.ancestors = ancestors
+            puts.append(desc)
+    ndb.put_multi(puts)
+    if puts:
+        logging.debug("Updated the ancestors of %d categories under %r"
+                      % (len(puts), cat_key))
+
 
 class Item(ndb.Model):
     added = ndb.DateTimeProperty(auto_now_add=True)
@@ -294,6 +695,47 @@ class Item(ndb.Model):
     category = ndb.KeyProperty(kind=Category, required=True)
     custom = ndb.JsonProperty()
     removed = ndb.DateTimeProperty()
+    # see hk.fingerprint()
+    fingerprint = ndb.StringProperty(indexed=False)
+    # see priceseries
+    price_series = ndb.BlobProperty()
+    # of the latest price, for re-pricing by currency
+    currency = ndb.ComputedProperty(
+        lambda self: self.price_history()[0].currency
+                     if self.price_series else None)
+
+    def price_history(self):
+        "Returns the PricePoints, the latest first"
+        if self.price_series is None:
+            return self._legacy_prices()[::-1]
+        return priceseries.unpack(self.price_series)[::-1]
+
+    def _legacy_prices(self):
+        """Returns the PricePoints of the Price children, for the items not
+        migrated yet, see migrate_prices().
+        """
+        if not self.key or migrated(PRICE_SERIES):
+            return []
+        return sorted(priceseries.PricePoint(p.timestamp, p.currency, p.cents)
+                      for p in Price.query(ancestor=self.key))
+
+    def add_price(self, currency, cents):
+        """Appends the price to the history unless it's the latest price
+        already. Returns True if appended.
+        """
+        check_currency(None, currency)
+        series = self.price_series
+        if series is None:
+            # folds the legacy prices in on the first write, migrate_prices()
+            # deletes them later
+            legacy = self._legacy_prices()
+            if legacy:
+                series = self.price_series = priceseries.merge(None, legacy)
+        series = priceseries.append(series, currency, cents)
+        if series is None:
+            return False
+        self.price_series = series
+        return True
 
 
 def check_currency(prop, cur):
@@ -303,18 +745,249 @@ def check_currency(prop, cur):
 
 
 class Price(ndb.Model):
+    """Legacy price history, see migrate_prices()."""
     timestamp = ndb.DateTimeProperty(auto_now_add=True)
     cents = ndb.IntegerProperty(required=True)
     currency = ndb.StringProperty(required=True, validator=check_currency)
 
 
+class ExchangeRate(ndb.Model):
+    """Daily snapshot, keyed by the ISO date."""
+    date = ndb.DateProperty(required=True)
+    fetched = ndb.DateTimeProperty(auto_now=True)
+    # {currency: value in USD}, as decimal strings
+    rates = ndb.JsonProperty(required=True)
+    # the rates the search documents were last priced with
+    indexed = ndb.JsonProperty()
+
+
+class ReindexJob(ndb.Model):
+    """Keyed by "reindex-<timestamp>", see search.reindex_items()."""
+    started = ndb.DateTimeProperty(auto_now_add=True)
+    finished = ndb.DateTimeProperty()
+    shards = ndb.IntegerProperty(required=True, indexed=False)
+    shards_done = ndb.IntegerProperty(default=0, indexed=False)
+    # the search index to fill, or None for search.write_indexes()
+    index = ndb.StringProperty(indexed=False)
+    # called with the job ID once all the shards are done
+    on_done = ndb.PickleProperty()
+
+    def shard_keys(self):
+        return [ndb.Key(ReindexShard, "%s:%d" % (self.key.id(), n))
+                for n in range(self.shards)]
+
+    def progress(self):
+        "Returns (items indexed, items per second of shard time)"
+        shards = filter(None, ndb.get_multi(self.shard_keys()))
+        indexed = sum(s.indexed for s in shards)
+        elapsed = sum(s.elapsed for s in shards)
+        return indexed, indexed / elapsed if elapsed else 0.
+
+
+class ReindexShard(ndb.Model):
+    """Keyed by "<job id>:<shard #>". Indexes the items with keys in
+    [start, end), either of which may be None.
+    """
+    job = ndb.KeyProperty(kind=ReindexJob, required=True)
+    start = ndb.KeyProperty(indexed=False)
+    end = ndb.KeyProperty(indexed=False)
+    cursor = ndb.StringProperty(indexed=False)
+    indexed = ndb.IntegerProperty(default=0, indexed=False)
+    # seconds spent indexing
+    elapsed = ndb.FloatProperty(default=0., indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True)
+    done = ndb.BooleanProperty(default=False)
+
+
+class IndexRegistry(ndb.Model):
+    """Keyed by "items". Searches use the `active` index, while a new one
+    is `building` the items are indexed to both. See search.build_index().
+    """
+    active = ndb.StringProperty(required=True, indexed=False)
+    building = ndb.StringProperty(indexed=False)
+    # the formerly active indexes, latest first
+    retired = ndb.StringProperty(repeated=True, indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+
 class Stat(polymodel.PolyModel):
     created = ndb.DateTimeProperty(auto_now_add=True)
 
 
 class ItemCounts(Stat):
     """Use store as parent."""
+    # {category ID: active items in the subtree}
     categories = ndb.JsonProperty()
+    # {category ID: active items in the category}, with the changes of
+    # ItemCountShard folded in by util.update_category_counts()
+    direct = ndb.JsonProperty()
+
+
+class ItemCountShard(ndb.Model):
+    """Keyed by "<store id>:<shard #>". Changes of the number of active
+    items per category ID, not folded into ItemCounts yet.
+    """
+    counts = ndb.JsonProperty()
+
+    SHARDS = 20
+
+    @classmethod
+    def shard_keys(cls, store_id):
+        return [ndb.Key(cls, "%s:%d" % (store_id, n))
+                for n in range(cls.SHARDS)]
+
+    @classmethod
+    @ndb.transactional(propagation=ndb.TransactionOptions.ALLOWED)
+    def add(cls, store_id, changes):
+        """Adds {category key: change} to a random shard. Joins the current
+        transaction, which needs to be cross-group.
+        """
+        changes = {str(ck.id()): n for ck, n in changes.iteritems()
+                   if ck and n}
+        if not changes:
+            return
+        key = cls.shard_keys(store_id)[randint(0, cls.SHARDS - 1)]
+        shard = key.get() or cls(key=key)
+        counts = shard.counts or {}
+        for cat_id, n in changes.iteritems():
+            counts[cat_id] = counts.get(cat_id, 0) + n
+        shard.counts = counts
+        shard.put()
+
+    @classmethod
+    def count(cls, item, prev_cat):
+        """Counts the item in its category, or in none if removed. Repeating
+        it is a no-op, as the counted category is kept in a CountedItem.
+        `prev_cat` is where the item was counted before, for the items with
+        no CountedItem yet. The transaction stays off the store's entity
+        group, which the scrape workers write all the time.
+        """
+        store_id, sku = item.key.parent().id(), item.key.id()
+        cat = None if item.removed else item.category
+
+        @ndb.transactional(xg=True)
+        def tx():
+            key = ndb.Key(CountedItem, "%s:%s" % (store_id, sku))
+            counted = key.get()
+            if counted is None:
+                counted = CountedItem(key=key, category=prev_cat)
+            elif counted.category == cat:
+                return
+            if counted.category != cat:
+                cls.add(store_id, {counted.category: -1, cat: 1})
+            counted.category = cat
+            counted.put()
+
+        tx()
+
+
+class CountedItem(ndb.Model):
+    """Keyed by "<store id>:<SKU>". The category an item is counted in by
+    ItemCountShard, None if not counted.
+    """
+    category = ndb.KeyProperty(kind=Category, indexed=False)
+
+
+class Migration(ndb.Model):
+    """Keyed by the name of a data migration, stored once it has run."""
+    done = ndb.DateTimeProperty(auto_now_add=True)
+
+
+CATEGORY_ANCESTORS = 'category-ancestors'
+PRICE_SERIES = 'price-series'
+
+# in-process, as a migration stays done
+_migrated = set()
+
+
+def migrated(name):
+    if name not in _migrated and Migration.get_by_id(name):
+        _migrated.add(name)
+    return name in _migrated
+
+
+def migrate_prices(cursor=None):
+    """Folds the Price children of items into Item.price_series, and deletes
+    them. Safe to run while scraping.
+    """
+    start = time.time()
+
+    @ndb.transactional
+    def fold(item_key):
+        prices = Price.query(ancestor=item_key).fetch()
+        if not prices:
+            return
+        item = item_key.get()
+        item.price_series = priceseries.merge(
+            item.price_series,
+            [priceseries.PricePoint(p.timestamp, p.currency, p.cents)
+             for p in prices])
+        item.put()
+        ndb.delete_multi([p.key for p in prices])
+        logging.debug("%r: folded %d prices" % (item_key, len(prices)))
+
+    while True:
+        keys, cursor, more = \
+            Item.query() \
+                .fetch_page(page_size=100,
+                            keys_only=True,
+                            start_cursor=cursor)
+        for key in keys:
+            fold(key)
+
+        if not (cursor and more):
+            break
+
+        if time.time() - start > 30:
+            deferred.defer(migrate_prices, cursor=cursor)
+            return
+
+    Migration(id=PRICE_SERIES).put()
+    logging.info("All prices migrated")
+
+
+def migrate_category_ancestors(cursor=None):
+    """Sets Category.ancestors from the parents, for the categories saved
+    before the property was added. Safe to run while scraping.
+    """
+    from .views import load_categories
+
+    start = time.time()
+    table = load_categories()
+
+    @ndb.transactional
+    def update(cat_key, parent_cat, ancestors):
+        cat = cat_key.get()
+        # unless moved meanwhile
+        if cat.parent_cat == parent_cat and cat.ancestors != ancestors:
+            cat.ancestors = ancestors
+            cat.put()
+
+    while True:
+        cats, cursor, more = \
+            Category.query() \
+                    .fetch_page(page_size=200, start_cursor=cursor)
+        fixes = {}
+        for cat in cats:
+            if cat.key.id() in table:
+                ancestors = table.path(cat.key.id())[:-1]
+                if cat.ancestors != ancestors:
+                    fixes[cat.key] = (cat.parent_cat, ancestors)
+        for cat_key, (parent_cat, ancestors) in fixes.iteritems():
+            update(cat_key, parent_cat, ancestors)
+        if fixes:
+            logging.debug("Updated the ancestors of %d categories"
+                          % len(fixes))
+
+        if not (cursor and more):
+            break
+
+        if time.time() - start > 30:
+            deferred.defer(migrate_category_ancestors, cursor=cursor)
+            return
+
+    Migration(id=CATEGORY_ANCESTORS).put()
+    logging.info("All category ancestors migrated")
 
 
 def get_duplicate_categories():
@@ -352,9 +1025,9 @@ def get_duplicate_categories():
 def prune_duplicate_categories():
     """WARNING: This function flushes memcache."""
     from .hk import by_url
-    from .search import reindex_items
+    from .search import queue_indexing, reindex_categories
     from .util import update_category_counts
-    from .views import get_categories
+    from .views import categories_changed
 
     assert not ScrapeJob.query().count(limit=1), \
         "Not pruning as a ScrapeJob exists"
@@ -366,6 +1039,7 @@ def prune_duplicate_categories():
 
     @ndb.transactional
     def move_to(item_key, to_cat):
+        "Returns the item if moved"
         item = item_key.get()
         if item.category != to_cat:
             prev_cat = item.category
@@ -373,24 +1047,25 @@ def prune_duplicate_categories():
             item.put()
             logging.info("Moved %r from %r to %r"
                          % (item_key, prev_cat, item.category))
-            return True
-        else:
-            return False
+            return item, prev_cat
 
     def move_items(from_cat, to_cat):
-        mod = False
+        moved = []
         for ikey in Item.query(Item.category == from_cat) \
                         .iter(batch_size=100, keys_only=True):
-            mod |= move_to(ikey, to_cat)
-        return mod
+            move = move_to(ikey, to_cat)
+            if move:
+                item, prev_cat = move
+                ItemCountShard.count(item, None if item.removed else prev_cat)
+                moved.append(ikey)
+        return moved
 
     @ndb.transactional
-    def move_child(child_cat, new_parent):
-        assert new_parent != child_cat
+    def move_child(child_cat, new_parent, ancestors):
         child = child_cat.get()
         if child.parent_cat != new_parent:
             prev_parent = child.parent_cat
-            child.parent_cat = new_parent
+            child.set_parent(new_parent, ancestors)
             child.put()
             logging.info("Moved %r from %r to %r"
                          % (child_cat, prev_parent, child.parent_cat))
@@ -412,7 +1087,7 @@ def prune_duplicate_categories():
 
         active = item_counts[0][0]
         prune = [ck for ck, c in item_counts[1:]]
-        mod = False
+        moved_cats, moved_items = [], []
 
         for cat_key in prune:
             children = Category.query(Category.parent_cat == cat_key) \
@@ -420,14 +1095,17 @@ def prune_duplicate_categories():
             if children:
                 logging.info("Moving children %r to %r"
                              % (children, active))
+                ancestors = active.get().ancestors + [active.id()]
                 for child in children:
-                    mod |= move_child(child, active)
+                    if move_child(child, active, ancestors):
+                        update_subtree_ancestors(child)
+                        moved_cats.append(child)
 
         logging.info("Moving items from %r to %r" % (prune, active))
         for cat_key in prune:
-            mod |= move_items(cat_key, active)
+            moved_items += move_items(cat_key, active)
 
-        if mod:
+        if moved_cats or moved_items:
             time.sleep(2)
 
         for cat_key in prune:
@@ -440,15 +1118,18 @@ def prune_duplicate_categories():
             cat_key.delete()
 
         logging.info("Deleted %r" % (prune,))
+        return moved_cats, moved_items
 
+    # the items whose category path has changed
+    moved_cats, moved_items = [], []
     for url, cats in dups.iteritems():
         logging.debug("Deduplicating %s" % url)
-        deduplicate([ck for ck, title, store in cats])
+        cat_keys, item_keys = deduplicate([ck for ck, title, store in cats])
+        moved_cats += cat_keys
+        moved_items += item_keys
         by_url(url, _invalidate=True)
-        # need to invalidate stores immediately as task execution may fail
-        stores = {store for ck, title, store in cats}
-        for store_id in stores:
-            get_categories(store_id=store_id, _invalidate=True)
+        # immediately, as task execution may fail
+        categories_changed()
 
     memcache.flush_all()
 
@@ -458,8 +1139,8 @@ def prune_duplicate_categories():
                        _queue='indexing',
                        _countdown=5)
 
-    # TODO could re-index only items that are under the
-    # final "singulated" categories
-    deferred.defer(reindex_items,
-                   _queue='indexing',
-                   _countdown=10)
+    queue_indexing(moved_items)
+    if moved_cats:
+        deferred.defer(reindex_categories, moved_cats,
+                       _queue='indexing',
+                       _countdown=10)
@@ -0,0 +1,113 @@
+"""Price history packed into a byte string, see Item.price_series.
+
+The format is a version byte, the currencies used as a count and 3 letter
+codes, and the points in chronological order. Each point is the seconds
+since the previous point (the first one since the epoch), the currency
+index and the change of cents from the previous point, as varints. The
+cents are zigzag encoded, so that price drops stay short too.
+"""
+from calendar import timegm
+from collections import namedtuple
+from datetime import datetime
+
+
+# the attributes match those of the legacy Price entities
+PricePoint = namedtuple('PricePoint', ('timestamp', 'currency', 'cents'))
+
+VERSION = 1
+
+
+def _varint(n):
+    out = bytearray()
+    while n > 0x7F:
+        out.append(0x80 | (n & 0x7F))
+        n >>= 7
+    out.append(n)
+    return out
+
+
+def _read_varint(data, offset):
+    n = shift = 0
+    while True:
+        b = data[offset]
+        offset += 1
+        n |= (b & 0x7F) << shift
+        if not b & 0x80:
+            return n, offset
+        shift += 7
+
+
+def _zigzag(n):
+    return n << 1 if n >= 0 else (-n << 1) - 1
+
+
+def _unzigzag(n):
+    return n >> 1 if not n & 1 else -((n + 1) >> 1)
+
+
+def pack(points):
+    """Packs PricePoints, in any order. Timestamps are stored with second
+    accuracy.
+    """
+    points = sorted(points)
+    currencies = sorted({p.currency for p in points})
+    index = {cur: n for n, cur in enumerate(currencies)}
+
+    out = bytearray([VERSION])
+    out += _varint(len(currencies))
+    for cur in currencies:
+        cur = cur.encode('ascii')
+        assert len(cur) == 3, "Invalid currency: %r" % (cur,)
+        out += cur
+    prev_ts = prev_cents = 0
+    for p in points:
+        ts = timegm(p.timestamp.utctimetuple())
+        out += _varint(ts - prev_ts)
+        out += _varint(index[p.currency])
+        out += _varint(_zigzag(p.cents - prev_cents))
+        prev_ts, prev_cents = ts, p.cents
+    return str(out)
+
+
+def unpack(data):
+    "Returns the PricePoints in chronological order"
+    if not data:
+        return []
+    data = bytearray(data)
+    if data[0] != VERSION:
+        raise ValueError("Unknown price series version %d" % data[0])
+    count, offset = _read_varint(data, 1)
+    currencies = []
+    for n in range(count):
+        currencies.append(str(data[offset:offset + 3]))
+        offset += 3
+    points = []
+    ts = cents = 0
+    while offset < len(data):
+        delta, offset = _read_varint(data, offset)
+        cur, offset = _read_varint(data, offset)
+        change, offset = _read_varint(data, offset)
+        ts += delta
+        cents += _unzigzag(change)
+        points.append(PricePoint(datetime.utcfromtimestamp(ts),
+                                 currencies[cur],
+                                 cents))
+    return points
+
+
+def append(data, currency, cents, timestamp=None):
+    """Returns the series with the price appended, or None if it's the
+    latest price already.
+    """
+    points = unpack(data)
+    if points and (points[-1].currency, points[-1].cents) == (currency, cents):
+        return None
+    points.append(PricePoint(timestamp or datetime.utcnow(), currency, cents))
+    return pack(points)
+
+
+def merge(data, points):
+    "Returns the series with the points added, dropping duplicates"
+    points = {p._replace(timestamp=p.timestamp.replace(microsecond=0))
+              for p in points}
+    return pack(points | set(unpack(data)))
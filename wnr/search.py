@@ -3,17 +3,33 @@ import decimal
 import json
 import logging
 import time
-from urllib import urlencode
 
-from google.appengine.api import search, urlfetch
+from google.appengine.api import search, taskqueue, urlfetch
 from google.appengine.ext import deferred, ndb
 
-from .models import Category, Item, Price
+import webapp2
+
+from .models import (
+    CATEGORY_ANCESTORS, Category, ExchangeRate, IndexRegistry, Item, Price,
+    ReindexJob, ReindexShard, migrated)
 from .util import cacheize, nubby, ok_resp
 
 
+# the active index until the first build_index()
 ITEMS_INDEX = 'items-20161212'
 
+INDEX_REGISTRY = ndb.Key(IndexRegistry, 'items')
+
+# keys of items waiting to be indexed, see queue_indexing()
+INDEXING_PULL_QUEUE = 'indexing-pull'
+
+# the Search API maximum of documents per put/delete
+INDEX_BATCH = 200
+
+# leases of a queued item before it's indexed alone, and dropped if that
+# fails too, see index_queued()
+INDEX_RETRIES = 5
+
 # 2016-12-14T10:27:40.492650
 _iso_format = "%Y-%m-%dT%H:%M:%S.%f"
 
@@ -21,6 +37,82 @@ _iso_format = "%Y-%m-%dT%H:%M:%S.%f"
 _iso_format_short = "%Y-%m-%dT%H:%M:%S"
 
 
+@cacheize(10 * 60)
+def index_names():
+    "Returns the names of the (active, building) item indexes"
+    registry = INDEX_REGISTRY.get()
+    if not registry:
+        return ITEMS_INDEX, None
+    return registry.active, registry.building
+
+
+def active_index():
+    return search.Index(index_names()[0])
+
+
+def write_indexes():
+    return filter(None, index_names())
+
+
+def build_index(name=None, shards=32):
+    """Fills a new item index in the background, and makes it the active
+    one once done. Meanwhile the items are indexed to both. Returns the
+    reindexing job ID.
+    """
+    name = name or "items-%s" % datetime.utcnow().strftime("%Y%m%d%H%M")
+
+    @ndb.transactional
+    def start():
+        registry = INDEX_REGISTRY.get() \
+                   or IndexRegistry(key=INDEX_REGISTRY, active=ITEMS_INDEX)
+        if registry.building:
+            raise ValueError("Already building %s" % registry.building)
+        if name == registry.active or name in registry.retired:
+            raise ValueError("Index %s has been used already" % name)
+        registry.building = name
+        registry.put()
+
+    start()
+    # writers pick up the new index before the items are read for it
+    index_names(_invalidate=True)
+    return reindex_items(shards, on_done=promote_index, index=name)
+
+
+def promote_index(job_id):
+    "Makes the index built by the job the active one"
+    name = ndb.Key(ReindexJob, job_id).get().index
+
+    @ndb.transactional
+    def flip():
+        registry = INDEX_REGISTRY.get()
+        if not registry or registry.building != name:
+            return False
+        registry.retired.insert(0, registry.active)
+        registry.active, registry.building = name, None
+        registry.put()
+        return True
+
+    if flip():
+        index_names(_invalidate=True)
+        logging.info("%s: %s is now the active index" % (job_id, name))
+    else:
+        logging.warn("%s: %s is not being built anymore" % (job_id, name))
+
+
+def cancel_index_build():
+    "Stops writing to the building index. Its reindexing job is not stopped."
+    @ndb.transactional
+    def tx():
+        registry = INDEX_REGISTRY.get()
+        if registry and registry.building:
+            logging.info("Cancelled building %s" % registry.building)
+            registry.building = None
+            registry.put()
+
+    tx()
+    index_names(_invalidate=True)
+
+
 def to_unix(dt):
     return int(time.mktime(dt.timetuple()))
 
@@ -29,31 +121,195 @@ def from_unix(seconds):
     return datetime.utcfromtimestamp(seconds)
 
 
-@cacheize(60 * 60)
-def us_exchange_rate(currency):
-    if currency == 'USD':
-        return decimal.Decimal(1)
-
-    query = {
-        'base': currency,
-        'symbols': "USD",
-    }
-    rs = urlfetch.fetch("http://api.fixer.io/latest?%s" % urlencode(query),
-                        deadline=30)
-    if rs.status_code == 422:
-        raise ValueError("Unknown currency %r" % (currency,))
-    ok_resp(rs)
+# re-price the documents of a currency once its rate has moved this much
+REPRICE_THRESHOLD = decimal.Decimal("0.005")
+
+# in-process cache of usd_rates(), {date: (expiry, rates)}
+_rates = {}
+
+
+def fetch_usd_rates():
+    rs = ok_resp(urlfetch.fetch("http://api.fixer.io/latest?base=USD",
+                                deadline=30))
     logging.debug("Response: %s" % rs.content)
-    # sample response: {"base":"EUR","date":"2016-12-12","rates":{"USD":1.0596}}
-    # (stupid float, but fortunately just informative...)
-    rs = json.loads(rs.content)
-    assert rs['base'] == currency
-    return decimal.Decimal(rs['rates']['USD'])
+    # sample response: {"base":"USD","date":"2016-12-12","rates":{"EUR":0.94375,...}}
+    rs = json.loads(rs.content, parse_float=decimal.Decimal)
+    assert rs['base'] == 'USD'
+    # the value of a unit in USD
+    context = decimal.Context(prec=12)
+    rates = {cur: str(context.divide(1, rate))
+             for cur, rate in rs['rates'].iteritems()}
+    rates['USD'] = "1"
+    return rates
+
+
+def refresh_exchange_rates():
+    """Stores today's snapshot of the rates, and re-prices the documents
+    of the currencies whose rate has moved since they were last priced.
+    """
+    rates = fetch_usd_rates()
+    today = datetime.utcnow().date()
+
+    latest = ExchangeRate.query().order(-ExchangeRate.date).get()
+    indexed = dict((latest.indexed or latest.rates) if latest else rates)
+    moved = []
+    for cur, rate in rates.iteritems():
+        if cur not in indexed:
+            indexed[cur] = rate
+        elif abs(decimal.Decimal(rate) / decimal.Decimal(indexed[cur]) - 1) \
+             > REPRICE_THRESHOLD:
+            indexed[cur] = rate
+            moved.append(cur)
+
+    ExchangeRate(id=today.isoformat(),
+                 date=today,
+                 rates=rates,
+                 indexed=indexed).put()
+    _rates.clear()
+    logging.info("Stored %d exchange rates, moved: %s"
+                 % (len(rates), ", ".join(sorted(moved)) or "-"))
+
+    for cur in moved:
+        deferred.defer(reprice_items, cur, _queue='indexing')
+
+
+def trigger_rate_refresh(rq):
+    deferred.defer(refresh_exchange_rates, _queue='indexing')
+    return webapp2.Response()
+
+
+def usd_rates(day):
+    """Returns {currency: value in USD} of the latest snapshot on or before
+    `day`, or the earliest snapshot. Never fetches the rates, a missing
+    snapshot of today is stored in the background meanwhile.
+    """
+    cached = _rates.get(day)
+    if cached and cached[0] > time.time():
+        return cached[1]
+
+    today = datetime.utcnow().date()
+    snapshot = ExchangeRate.query(ExchangeRate.date <= day) \
+                           .order(-ExchangeRate.date) \
+                           .get() \
+               or ExchangeRate.query() \
+                              .order(ExchangeRate.date) \
+                              .get()
+    if not snapshot or (day >= today and snapshot.date < today):
+        try:
+            deferred.defer(refresh_exchange_rates,
+                           _name="exchange-rates-%s" % today.isoformat(),
+                           _queue='indexing')
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+    if not snapshot:
+        # only until the first snapshot is stored, index_queued() releases
+        # the items for the retry
+        raise LookupError("No exchange rates stored yet")
+
+    rates = {cur: decimal.Decimal(rate)
+             for cur, rate in snapshot.rates.iteritems()}
+    # past days are final, today's snapshot may be refreshed
+    if day < today:
+        expiry = float('inf')
+    else:
+        expiry = time.time() + 10 * 60
+    _rates[day] = (expiry, rates)
+    return rates
+
+
+def to_us_cents(price, day=None):
+    """Converts with the rate of `day`, by default the day of the price."""
+    if price.currency == 'USD':
+        rate = 1
+    else:
+        rates = usd_rates(day or price.timestamp.date())
+        try:
+            rate = rates[price.currency]
+        except KeyError:
+            raise ValueError("Unknown currency %r" % (price.currency,))
+    us_cents = rate * price.cents
+    return int(decimal.Decimal(us_cents).quantize(1, decimal.ROUND_HALF_UP))
+
+
+def reprice_items(currency, cursor=None):
+    """Re-indexes the items whose latest price is in `currency`."""
+    start = time.time()
+
+    while True:
+        keys, cursor, more = \
+            Item.query(Item.currency == currency) \
+                .fetch_page(page_size=500,
+                            keys_only=True,
+                            start_cursor=cursor)
+        queue_indexing(keys)
+
+        if not (cursor and more):
+            break
+
+        if time.time() - start > 30:
+            deferred.defer(reprice_items, currency,
+                           cursor=cursor,
+                           _queue='indexing')
+            return
+
+    logging.info("All %s items queued for re-pricing" % currency)
+
+
+def _descendants_by_parent(cat_keys):
+    "Walks the subtrees of the categories down the parents"
+    from .views import get_categories
 
+    cats = get_categories(fresh=True)
+    stack = [cat_key.id() for cat_key in cat_keys]
+    seen = set(stack)
+    while stack:
+        cat_id = stack.pop()
+        if cat_id in cats:
+            for child_id in cats.children(cat_id):
+                if child_id not in seen:
+                    seen.add(child_id)
+                    stack.append(child_id)
+    return [ndb.Key(Category, cat_id) for cat_id in seen]
+
+
+def reindex_categories(cat_keys, cursor=None, subtrees=True):
+    """Queues the items in the subtrees of the categories for indexing, eg.
+    after moving the categories. Only the category IDs are indexed, so
+    renaming a category needs no reindexing.
+    """
+    start = time.time()
+    if subtrees:
+        cat_keys = set(cat_keys)
+        if migrated(CATEGORY_ANCESTORS):
+            for cat_key in list(cat_keys):
+                cat_keys.update(
+                    Category.query(Category.ancestors == cat_key.id())
+                            .fetch(keys_only=True))
+        else:
+            cat_keys.update(_descendants_by_parent(cat_keys))
+    cat_keys = sorted(cat_keys)
 
-def to_us_cents(price):
-    us_cents = us_exchange_rate(price.currency) * price.cents
-    return int(us_cents.quantize(1, decimal.ROUND_HALF_UP))
+    while cat_keys:
+        cat_key = cat_keys[0]
+        keys, cursor, more = \
+            Item.query(Item.category == cat_key) \
+                .fetch_page(page_size=500,
+                            keys_only=True,
+                            start_cursor=cursor)
+        queue_indexing(keys)
+
+        if not (cursor and more):
+            cat_keys.pop(0)
+            cursor = None
+
+        if cat_keys and time.time() - start > 30:
+            deferred.defer(reindex_categories, cat_keys,
+                           cursor=cursor,
+                           subtrees=False,
+                           _queue='indexing')
+            return
+
+    logging.info("All items of the categories queued for indexing")
 
 
 def format_history_price(price):
@@ -75,26 +331,19 @@ def parse_history_price(price):
             decimal.Decimal(amt))
 
 
-def index_items(item_keys):
+def index_items(item_keys, indexes=None):
+    """Indexes to the named `indexes`, by default to write_indexes()."""
     from .views import get_categories
 
-    categories = get_categories()
+    # the items may be in categories created just now
+    categories = get_categories(fresh=True)
 
     def cat_path(item_key, cat_key):
-        path = []
-        while cat_key:
-            try:
-                store, title, parent_id = categories[cat_key.id()]
-            except KeyError:
-                raise KeyError("Category not found, %r: %r %r"
-                               % (item_key, cat_key, path))
-            path.insert(0, cat_key)
-            cat_key = None
-            if parent_id:
-                parent = ndb.Key(Category, parent_id)
-                if parent not in path:
-                    cat_key = parent
-        return path
+        try:
+            return categories.path(cat_key.id())
+        except KeyError:
+            raise KeyError("Category not found, %r: %r"
+                           % (item_key, cat_key))
 
     def item_data(item):
         fields = [search.AtomField('store', item.key.parent().id()),
@@ -120,19 +369,21 @@ def index_items(item_keys):
 
         facets = []
         if item.category:
-            id_path = ["%d" % ck.id()
-                       for ck in cat_path(item.key, item.category)]
+            id_path = ["%d" % cat_id
+                       for cat_id in cat_path(item.key, item.category)]
             if id_path:
                 fields.append(search.TextField('categories', " ".join(id_path)))
                 # NumberFacet is 30 bit
                 facets += [search.AtomFacet('category', cat_id)
                            for cat_id in id_path]
 
-        prices = Price.query(ancestor=item.key) \
-                      .order(-Price.timestamp) \
-                      .fetch()
+        prices = item.price_history()
         if prices:
-            us_cents = map(to_us_cents, prices)
+            # the current price at today's rate, the history at the rates
+            # of the time
+            today = datetime.utcnow().date()
+            us_cents = [to_us_cents(prices[0], today)] \
+                       + map(to_us_cents, prices[1:])
             fields += [
                 search.NumberField('us_cents', us_cents[0]),
                 search.TextField('price_history', " ".join(map(format_history_price, prices))),
@@ -187,42 +438,190 @@ def index_items(item_keys):
         else:
             dels.append(doc_id)
 
-    index = search.Index(ITEMS_INDEX)
     if adds:
         logging.debug("Indexing %d documents:" % len(adds))
         for n, doc in enumerate(adds, start=1):
             logging.debug("%d: %s" % (n, doc))
-        index.put(adds)
     if dels:
         logging.debug("Deleting %d documents: %s" % (len(dels), dels))
-        index.delete(dels)
+    for name in indexes or write_indexes():
+        index = search.Index(name)
+        if adds:
+            index.put(adds)
+        if dels:
+            index.delete(dels)
+
+
+def queue_indexing(item_keys, transactional=False):
+    """Appends the items to the indexing pull queue, to be indexed in
+    batches by index_queued(). Transactional callers need to call
+    schedule_indexing() after the transaction.
+    """
+    tasks = [taskqueue.Task(payload=key.urlsafe(), method='PULL')
+             for key in item_keys]
+    if not tasks:
+        return
+    queue = taskqueue.Queue(INDEXING_PULL_QUEUE)
+    for n in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+        queue.add(tasks[n:n + taskqueue.MAX_TASKS_PER_ADD],
+                  transactional=transactional)
+    if not transactional:
+        schedule_indexing()
+
+
+def schedule_indexing(countdown=5):
+    # one consumer per `countdown` seconds, coalescing the items queued
+    # meanwhile; it runs after the window has passed
+    window = int(time.time() / countdown)
+    try:
+        deferred.defer(index_queued,
+                       _name="index-queued-%d" % window,
+                       _countdown=countdown,
+                       _queue='indexing')
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
 
 
-def reindex_items(cursor=None):
+def index_queued():
     start = time.time()
+    queue = taskqueue.Queue(INDEXING_PULL_QUEUE)
 
     while True:
-        keys, cursor, more = \
-            Item.query() \
-                .order(-Item.added) \
-                .fetch_page(page_size=50,
-                            keys_only=True,
-                            start_cursor=cursor)
-        if not keys:
+        tasks = queue.lease_tasks(lease_seconds=60, max_tasks=INDEX_BATCH)
+        if not tasks:
             break
 
-        index_items(keys)
+        # probably failing with a bad item, so that one can't hold back
+        # the whole batch for good
+        retried = [task for task in tasks if task.retry_count > INDEX_RETRIES]
+        for task in retried:
+            try:
+                index_items([ndb.Key(urlsafe=task.payload)])
+            except Exception:
+                logging.exception("Dropping %s from indexing after %d leases"
+                                  % (task.payload, task.retry_count))
+            queue.delete_tasks(task)
+
+        batch = [task for task in tasks if task.retry_count <= INDEX_RETRIES]
+        keys = {ndb.Key(urlsafe=task.payload) for task in batch}
+        logging.info("Indexing %d items (%d queued)" % (len(keys), len(batch)))
+        try:
+            if keys:
+                index_items(list(keys))
+        except Exception:
+            # available again to the retry, rather than after the lease
+            for task in batch:
+                queue.modify_task_lease(task, 0)
+            raise
+        if batch:
+            queue.delete_tasks(batch)
+
+        if len(tasks) < INDEX_BATCH:
+            break
 
+        if time.time() - start > 30:
+            deferred.defer(index_queued, _queue='indexing')
+            return
+
+
+def split_item_keys(shards, oversampling=32):
+    """Returns up to `shards - 1` keys splitting the items into ranges of
+    about equal size, from a random sample of keys.
+    """
+    sample = Item.query() \
+                 .order(ndb.GenericProperty('__scatter__')) \
+                 .fetch(shards * oversampling, keys_only=True)
+    sample.sort()
+    return sorted({sample[len(sample) * n / shards]
+                   for n in range(1, shards)
+                   if sample})
+
+
+def reindex_items(shards=8, on_done=None, index=None, cursor=None):
+    """Reindexes all items in `shards` key ranges, concurrently on the
+    indexing queue, to `index` or by default to write_indexes(). `on_done`
+    is deferred with the job ID once all the ranges are done. Returns the
+    job ID.
+
+    `cursor` is ignored, it's from the tasks of the earlier sequential
+    reindexing, which start over with this.
+    """
+    # to the microsecond, so that jobs started in the same second don't
+    # overwrite each other
+    job_id = "reindex-%s" % datetime.utcnow().strftime("%Y%m%d%H%M%S%f")
+    splits = split_item_keys(shards)
+    bounds = zip([None] + splits, splits + [None])
+    job = ReindexJob(id=job_id, shards=len(bounds), index=index,
+                     on_done=on_done)
+    ranges = [ReindexShard(key=key, job=job.key, start=start, end=end)
+              for key, (start, end) in zip(job.shard_keys(), bounds)]
+    ndb.put_multi([job] + ranges)
+    for shard in ranges:
+        deferred.defer(reindex_shard, shard.key.id(), _queue='indexing')
+    logging.info("%s: reindexing in %d shards" % (job_id, len(ranges)))
+    return job_id
+
+
+def reindex_shard(shard_id):
+    start = time.time()
+    shard = ndb.Key(ReindexShard, shard_id).get()
+    if shard.done:
+        return
+    index = shard.job.get().index
+    indexes = [index] if index else None
+
+    query = Item.query()
+    if shard.start:
+        query = query.filter(Item.key >= shard.start)
+    if shard.end:
+        query = query.filter(Item.key < shard.end)
+    query = query.order(Item.key)
+
+    # the progress is saved per batch, retries continue from it
+    cursor = ndb.Cursor(urlsafe=shard.cursor) if shard.cursor else None
+    while True:
+        batch_start = time.time()
+        keys, cursor, more = query.fetch_page(page_size=INDEX_BATCH,
+                                              keys_only=True,
+                                              start_cursor=cursor)
+        if keys:
+            index_items(keys, indexes)
+
+        shard.indexed += len(keys)
+        shard.elapsed += time.time() - batch_start
+        shard.cursor = cursor.urlsafe() if cursor else None
         if not (cursor and more):
             break
+        shard.put()
 
         if time.time() - start > 30:
-            deferred.defer(reindex_items,
-                           cursor=cursor,
-                           _queue='indexing')
+            deferred.defer(reindex_shard, shard_id, _queue='indexing')
             return
 
-    logging.info("All items reindexed")
+    finish_reindex_shard(shard)
+
+
+@ndb.transactional(xg=True)
+def finish_reindex_shard(shard):
+    if shard.key.get().done:
+        return
+    shard.done = True
+    job = shard.job.get()
+    job.shards_done += 1
+    logging.info("%s: %d items in %.1fs (%.1f/s), %d/%d shards done"
+                 % (shard.key.id(),
+                    shard.indexed,
+                    shard.elapsed,
+                    shard.indexed / shard.elapsed if shard.elapsed else 0.,
+                    job.shards_done,
+                    job.shards))
+    if job.shards_done == job.shards:
+        job.finished = datetime.utcnow()
+        if job.on_done:
+            deferred.defer(job.on_done, job.key.id(),
+                           _transactional=True,
+                           _queue='indexing')
+    ndb.put_multi([shard, job])
 
 
 def delete_items(item_keys):
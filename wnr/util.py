@@ -1,6 +1,5 @@
 import hashlib
 import logging
-import time
 import urllib
 
 from google.appengine.api import memcache as memcache_module, urlfetch
@@ -12,7 +11,7 @@ import webapp2
 
 from settings import env
 
-from .models import Category, Item, ItemCounts, Store
+from .models import Category, Item, ItemCounts, ItemCountShard, Store
 
 
 # "alias" just to get rid of pydev error...
@@ -51,66 +50,61 @@ def cache(expiry):
     return outer
 
 
-def update_category_counts(store_id):
+def count_items(store_id):
+    "Returns {category ID: active items in the category}, from queries"
+    return {str(cat_key.id()): Item.query(Item.category == cat_key,
+                                          Item.removed == None)
+                                   .count()
+            for cat_key in Category.query(Category.store == store_id)
+                                   .iter(batch_size=200, keys_only=True)}
+
+
+def update_category_counts(store_id, recount=False):
+    """Folds the ItemCountShard changes into the ItemCounts of the store,
+    and totals the subtrees. The first time, or with `recount`, the items
+    are counted with queries instead, and the changes meanwhile are lost.
+    """
     from .views import get_categories
 
-    cats, children = set(), {}
-    for cat in Category.query(Category.store == store_id,
-                              projection=(Category.parent_cat,)) \
-                       .iter(batch_size=200):
-        cats.add(cat.key)
-        if cat.parent_cat:
-            children.setdefault(cat.parent_cat, set()) \
-                    .add(cat.key)
-
-    def item_count(cat_key):
-        ic = Item.query(Item.category == cat_key,
-                        Item.removed == None) \
-                 .count()
-        childs = children.get(cat_key)
-        if childs:
-            ic += sum(item_counts[ck] for ck in childs)
-        return ic
-
-    def debug_children(ck):
-        return "%d: %r" % (ck.id(), children.get(ck))
-
-    item_counts = {}
-    while cats:
-        seen = set(item_counts.iterkeys())
-        leaves = {ck for ck in cats
-                  if children.get(ck, set()) <= seen}
-        assert leaves, "%d categories left:\n%s" \
-                       % (len(cats), "\n".join(map(debug_children, cats)))
-        item_counts.update({ck: item_count(ck) for ck in leaves})
-        cats -= leaves
-
-    # reduce keys to *string* IDs for JSON
-    item_counts = {str(ck.id()): c for ck, c in item_counts.iteritems()}
-
-    @ndb.transactional
-    def save_counts(store):
-        stat = ItemCounts.query(ancestor=store) \
-                         .get()
-        if stat:
-            stat.categories = item_counts
+    store = ndb.Key(Store, store_id)
+    stat = ItemCounts.query(ancestor=store).get()
+    counted = None
+    if recount or not (stat and stat.direct is not None):
+        counted = count_items(store_id)
+
+    cats = get_categories(store_id, fresh=True)
+
+    def subtree_counts(direct):
+        totals = {cat_id: 0 for cat_id in cats}
+        for cat_id in cats:
+            count = direct.get(str(cat_id))
+            if count:
+                for anc_id in cats.path(cat_id):
+                    totals[anc_id] += count
+        # reduce keys to *string* IDs for JSON
+        return {str(cat_id): c for cat_id, c in totals.iteritems()}
+
+    @ndb.transactional(xg=True)
+    def save_counts():
+        stat = ItemCounts.query(ancestor=store).get() \
+               or ItemCounts(parent=store)
+        shards = filter(None,
+                        ndb.get_multi(ItemCountShard.shard_keys(store_id)))
+        if counted is not None:
+            direct = counted
         else:
-            stat = ItemCounts(parent=store,
-                              categories=item_counts)
+            direct = dict(stat.direct)
+            for shard in shards:
+                for cat_id, change in (shard.counts or {}).iteritems():
+                    direct[cat_id] = direct.get(cat_id, 0) + change
+        ndb.delete_multi([shard.key for shard in shards])
+        stat.direct = direct
+        stat.categories = subtree_counts(direct)
         stat.put()
-        logging.debug("Saved %d counts to %r"
-                      % (len(item_counts), stat.key))
-
-    save_counts(ndb.Key(Store, store_id))
+        logging.debug("Saved %d counts to %r, %d change shards folded"
+                      % (len(stat.categories), stat.key, len(shards)))
 
-    time.sleep(1)
-    get_categories(_invalidate=True)
-    stores = {cat.store
-              for cat in Category.query(group_by=('store',),
-                                        projection=('store',))
-                                 .fetch()}
-    for store_id in stores:
-        get_categories(store_id=store_id, _invalidate=True)
+    save_counts()
 
 
 def ok_resp(rs):
@@ -171,6 +165,31 @@ def cacheize(timeout, version=""):
     return outer
 
 
+# below the 1MB limit of memcache values
+MEMCACHE_CHUNK = 1000 * 1000
+
+
+def set_chunked(key, data, timeout):
+    "Stores a string of any size as MEMCACHE_CHUNK sized values"
+    chunks = {"%s:%d" % (key, n): data[pos:pos + MEMCACHE_CHUNK]
+              for n, pos in enumerate(xrange(0, len(data), MEMCACHE_CHUNK))}
+    chunks[key] = len(chunks)
+    memcache.set_multi(chunks, timeout)
+
+
+def get_chunked(key):
+    "Returns a string stored with set_chunked(), or None"
+    count = memcache.get(key)
+    if count is None:
+        return None
+    keys = ["%s:%d" % (key, n) for n in range(count)]
+    chunks = memcache.get_multi(keys)
+    if len(chunks) < count:
+        # partly evicted
+        return None
+    return "".join(chunks[k] for k in keys)
+
+
 def nubby(key, itr):
     l, seen = [], set()
     for v in itr:
@@ -7,14 +7,20 @@ import time
 import urllib
 
 from google.appengine.api import search as g_search, urlfetch
-from google.appengine.ext import ndb
+from google.appengine.ext import deferred, ndb
 
 import webapp2
 
 from . import get_stores
-from .models import Category, Item, ItemCounts, Store
-from .search import from_unix, ITEMS_INDEX, parse_history_price
-from .util import cache, cacheize, not_found, nub, qset, redir, render
+from . import categorytable
+from .categorytable import CategoryTable
+from .models import (
+    CATEGORY_ANCESTORS, Category, Item, ItemCounts, PRICE_SERIES, Store,
+    migrate_category_ancestors, migrate_prices, migrated)
+from .search import active_index, from_unix, parse_history_price
+from .util import (
+    cache, get_chunked, memcache, not_found, nub, qset, redir,
+    render, set_chunked)
 
 
 PARAM = namedtuple(
@@ -90,12 +96,9 @@ class ItemView(object):
         except ValueError:
             self.category_path = []
         else:
-            cat_ids = map(int, cats.split(" "))
-            cat_infos = map(categories.get, cat_ids)
-            self.category_path = \
-                [(cat_id, cat_info[1])
-                 for cat_id, cat_info in zip(cat_ids, cat_infos)
-                 if cat_info]
+            self.category_path = [(cat_id, categories.title(cat_id))
+                                  for cat_id in map(int, cats.split(" "))
+                                  if cat_id in categories]
 
     def __getattr__(self, name):
         return self.doc.field(name).value
@@ -114,8 +117,59 @@ class ItemView(object):
         return "ItemView(%r)" % (self.doc,)
 
 
-@cacheize(24 * 60 * 60)
-def get_categories(store_id=None):
+# incremented on every change of the categories, see get_categories()
+CATEGORIES_GENERATION = "categories-generation"
+
+# seconds an instance uses its categories without checking the generation
+CATEGORIES_TTL = 10
+
+# {store_id: (generation, expiry, CategoryTable)}
+_categories = {}
+
+
+def categories_generation():
+    gen = memcache.get(CATEGORIES_GENERATION)
+    if gen is None:
+        # not to reuse generations after an eviction
+        memcache.add(CATEGORIES_GENERATION, int(time.time() * 1000))
+        gen = memcache.get(CATEGORIES_GENERATION)
+    return gen
+
+
+def categories_changed():
+    "Invalidates all cached copies of get_categories()"
+    memcache.incr(CATEGORIES_GENERATION,
+                  initial_value=int(time.time() * 1000))
+
+
+def get_categories(store_id=None, fresh=False):
+    """Returns a CategoryTable of all categories, or of the store. Cached in
+    the instance for CATEGORIES_TTL seconds, or with `fresh` for as long as
+    the generation is current. Not cached while memcache is unavailable.
+    """
+    cached = _categories.get(store_id)
+    if cached and not fresh and cached[1] > time.time():
+        return cached[2]
+
+    gen = categories_generation()
+    if gen is None:
+        # memcache is down, so changes couldn't be seen either
+        return load_categories(store_id)
+    if cached and cached[0] == gen:
+        cats = cached[2]
+    else:
+        key = "categories#%d.%s(%s)" % (categorytable.VERSION, gen, store_id)
+        data = get_chunked(key)
+        if data is None:
+            cats = load_categories(store_id)
+            set_chunked(key, cats.tostring(), 24 * 60 * 60)
+        else:
+            cats = CategoryTable.fromstring(data)
+    _categories[store_id] = (gen, time.time() + CATEGORIES_TTL, cats)
+    return cats
+
+
+def load_categories(store_id=None):
     def key_id(key):
         if key:
             return key.id()
@@ -127,8 +181,8 @@ def get_categories(store_id=None):
                                       Category.parent_cat,
                                       # included here to avoid an extra index
                                       Category.url))
-        return {c.key.id(): (c.title, key_id(c.parent_cat))
-                for c in q}
+        rows = ((c.key.id(), store_id, c.title, key_id(c.parent_cat))
+                for c in q)
     else:
         q = Category.query() \
                     .iter(batch_size=200,
@@ -137,8 +191,9 @@ def get_categories(store_id=None):
                                       Category.parent_cat,
                                       # included here to avoid an extra index
                                       Category.url))
-        return {c.key.id(): (c.store, c.title, key_id(c.parent_cat))
-                for c in q}
+        rows = ((c.key.id(), c.store, c.title, key_id(c.parent_cat))
+                for c in q)
+    return CategoryTable.build(rows)
 
 
 class log_latency(object):
@@ -219,7 +274,7 @@ def search(rq):
         sort = g_search.SortOptions(
                    [sort], limit=g_search.MAXIMUM_SORTED_DOCUMENTS)
 
-    index = g_search.Index(ITEMS_INDEX)
+    index = active_index()
     opts = g_search.QueryOptions(
                limit=page_size,
                number_found_accuracy=g_search.MAXIMUM_SORTED_DOCUMENTS
@@ -420,38 +475,23 @@ def categories(rq, store):
     else:
         item_counts = {}
 
-    cats = get_categories(store).items()
-    if item_counts:
-        # filter out empty if we have item counts
-        cats = filter(lambda (cat_id, cat): item_counts.get(str(cat_id)) > 0,
-                      cats)
-
-    children = {}
-    for tup in cats:
-        parent_id = tup[1][1]
-        if parent_id:
-            children.setdefault(parent_id, []) \
-                    .append(tup)
-
-    def name_sort((cat_id, (title, parent_id))):
-        return title
+    cats = get_categories(store)
 
-    for childs in children.itervalues():
-        childs.sort(key=name_sort)
+    def children(cat_id):
+        childs = cats.children(cat_id)
+        if item_counts:
+            # filter out empty if we have item counts
+            childs = [ck for ck in childs if item_counts.get(str(ck)) > 0]
+        return sorted(childs, key=cats.title)
 
-    def traverse(cat_id, title):
+    def traverse(cat_id):
         return {
             'id': cat_id,
-            'title': title,
-            'children': [traverse(cat_id, title)
-                         for cat_id, (title, parent_id)
-                         in children.get(cat_id, [])],
+            'title': cats.title(cat_id),
+            'children': map(traverse, children(cat_id)),
         }
 
-    root = filter(lambda (cat_id, (title, parent_id)): not parent_id, cats)
-    root.sort(key=name_sort)
-
-    tree = [traverse(cat_id, title) for cat_id, (title, parent_id) in root]
+    tree = map(traverse, children(None))
 
     def add_counts(cat):
         cat['item_count'] = item_counts.get(str(cat['id']))
@@ -476,30 +516,41 @@ def shutdown(rq):
     return webapp2.Response("", content_type="text/plain")
 
 
-def validate_category_tree():
-    children, remaining = {}, {}
-    for cat_id, (store_id, title, parent_id) in get_categories().iteritems():
-        children.setdefault(parent_id, []) \
-                .append(cat_id)
-        remaining[cat_id] = (title, parent_id)
-
-    def traverse(path=()):
-        if path:
-            cat_id = path[-1]
-            title, parent_id = remaining.pop(cat_id)
-            childs = children.pop(cat_id, [])
-        else:
-            childs = children.pop(None)
-        for child_id in childs:
-            traverse(path + (child_id,))
+def trigger_migrations(rq):
+    "Runs the data migrations not done yet, from cron"
+    if not migrated(CATEGORY_ANCESTORS):
+        deferred.defer(migrate_category_ancestors)
+    if not migrated(PRICE_SERIES):
+        deferred.defer(migrate_prices)
+    return webapp2.Response()
 
-    traverse()
 
-    def cat_info((cat_id, (title, parent_id))):
-        return "- '%s' (%d, parent %s)" % (title, cat_id, parent_id)
-
-    assert not remaining, \
-        "%d unreachable categories:\n%s" \
-        % (len(remaining), "\n".join(map(cat_info, remaining.iteritems())))
+def validate_category_tree():
+    """Checks that all categories are reachable from a root, and the stored
+    Category.ancestors against the parents. Cycles are refused when saving,
+    see Category.set_parent().
+    """
+    cats = load_categories()
+    unreachable, invalid = [], []
+    for cat in Category.query():
+        path = cats.path(cat.key.id())
+        # the table drops missing parents, and cuts the paths in a cycle
+        # short of a root
+        if cat.parent_cat and (cat.parent_cat.id() not in cats
+                               or cats.get(path[0])[2] is not None):
+            unreachable.append(cat)
+        elif cat.ancestors != path[:-1]:
+            invalid.append(cat)
+
+    def cat_info(cat):
+        return "- '%s' (%d, parent %s, ancestors %s)" \
+               % (cat.title, cat.key.id(), cat.parent_cat, cat.ancestors)
+
+    assert not unreachable, \
+        "%d categories not reachable from a root:\n%s" \
+        % (len(unreachable), "\n".join(map(cat_info, unreachable)))
+    assert not invalid, \
+        "%d categories with invalid ancestors:\n%s" \
+        % (len(invalid), "\n".join(map(cat_info, invalid)))
 
     logging.info("Category tree seems ok")